@@ -0,0 +1,115 @@
+"""
+Client for Michael's activity feed on mknepprath.com.
+
+The feed is small, but the site can be slow and the bot runs hourly, so:
+
+- every request has a hard timeout (ACTIVITY_TIMEOUT), and goes over the
+  pooled keep-alive session from http_pool.py
+- the last response is kept under /tmp at ACTIVITY_CACHE_PATH, filled in
+  for each persona (see persona.py), and parsed in
+  the warm cache (see warm_cache.py); within ACTIVITY_TTL it's used without
+  a request, after that it's revalidated with If-None-Match /
+  If-Modified-Since, so a warm Lambda usually gets a 304
+- if the site errors or times out, a stale cached copy is better than nothing
+
+Items are parsed once into ActivityItem records; callers format them.
+"""
+import json
+import os
+import threading
+import time
+from html import unescape
+from typing import NamedTuple
+
+import http_pool
+import warm_cache
+from local_settings import *
+
+
+class ActivityItem(NamedTuple):
+    type: str
+    action: str
+    title: str
+    summary: str
+
+
+_lock = threading.Lock()
+
+
+def parse(data):
+    return [
+        ActivityItem(
+            type=item.get("type", ""),
+            action=item.get("action", ""),
+            title=unescape(item.get("title", "") or ""),
+            summary=item.get("summary", "") or "",
+        )
+        for item in data
+    ]
+
+
+def _read_cache(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _write_cache(path, cache):
+    try:
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"Error caching activity feed: {e}")
+
+
+def _remember(url, cache):
+    items = parse(cache["data"])
+    warm_cache.put(("activity", url), items, ACTIVITY_TTL - (time.time() - cache["fetched_at"]))
+    return items
+
+
+def fetch(url, path=ACTIVITY_CACHE_PATH):
+    """Recent activity as ActivityItem records, from the cache at `path` when it's fresh."""
+    with _lock:
+        items = warm_cache.get(("activity", url))
+        if items is not None:
+            return items
+
+        cache = _read_cache(path)
+        if cache and cache.get("url") != url:
+            cache = None
+        if cache and time.time() - cache["fetched_at"] < ACTIVITY_TTL:
+            return _remember(url, cache)
+
+        headers = {}
+        if cache and cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache and cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+
+        try:
+            response = http_pool.session().get(url, headers=headers, timeout=ACTIVITY_TIMEOUT)
+            if response.status_code == 304 and cache:
+                print("Activity feed not modified")
+            else:
+                response.raise_for_status()
+                cache = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "data": response.json(),
+                }
+        except Exception as e:
+            if not cache:
+                raise
+            # Serve the stale copy, but leave it stale so the next run retries
+            print(f"Error fetching activity feed, using cached copy: {e}")
+            return parse(cache["data"])
+
+        cache["fetched_at"] = time.time()
+        _write_cache(path, cache)
+        return _remember(url, cache)
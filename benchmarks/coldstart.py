@@ -0,0 +1,93 @@
+"""
+Cold-start benchmark for ebooks.py.
+
+Each scenario runs in a fresh interpreter, the way a new Lambda container
+would, and reports the median wall time over several runs:
+
+- eager:     what importing ebooks.py used to cost (both SDKs, the Anthropic
+             client and voice_samples.json, all at import time)
+- import:    importing ebooks.py now
+- asleep:    import + main() at 3am, which returns before touching any client
+- no-action: import + main() up to the point where it would first talk to
+             Mastodon (Lilt runs every awake hour), with nothing rolled
+
+Usage: python benchmarks/coldstart.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PRELUDE = """
+import time
+start = time.perf_counter()
+"""
+
+SCENARIOS = {
+    "eager": """
+import json, os
+import anthropic
+from mastodon import Mastodon
+anthropic.Anthropic(api_key="x")
+with open("voice_samples.json") as f:
+    json.load(f)
+import ebooks
+""",
+    "import": """
+import ebooks
+""",
+    "asleep": """
+import datetime as dt
+import ebooks
+
+class Night(dt.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return dt.datetime(2024, 1, 1, 3, 0, tzinfo=tz)
+
+ebooks.datetime = Night
+ebooks.main()
+""",
+    "no-action": """
+import random
+import ebooks
+from mastodon_client import CachedMastodon
+
+random.choice = lambda seq: seq[-1]
+mastodon = CachedMastodon(ebooks.connect_mastodon)
+mastodon.client
+""",
+}
+
+EPILOGUE = """
+print(time.perf_counter() - start)
+"""
+
+
+def run_once(code):
+    out = subprocess.run(
+        [sys.executable, "-c", PRELUDE + code + EPILOGUE],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    results = {}
+    for name, code in SCENARIOS.items():
+        results[name] = statistics.median(run_once(code) for _ in range(runs))
+
+    baseline = results["eager"]
+    for name, seconds in results.items():
+        saved = (baseline - seconds) * 1000
+        print(f"{name:>10}: {seconds * 1000:7.1f} ms  ({saved:7.1f} ms saved vs eager)")
+
+
+if __name__ == "__main__":
+    main()
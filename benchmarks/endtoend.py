@@ -0,0 +1,450 @@
+"""
+End-to-end benchmark for ebooks.main(), fully offline.
+
+Starts one local HTTP server that stands in for mastodon.social, the
+Anthropic Messages API and the activity feed, then runs main() against it
+once per feature path, each in a fresh interpreter with its own state
+directory. Rolls are forced through ebooks.roll, so each path runs exactly
+the features named below (Lilt runs every time, as it does live).
+
+The stand-in Mastodon serves timelines built from voice_samples.json, a
+mention shaped like example_tweet.json, and paginated follower lists. It
+sends rate-limit headers and answers writes the way Mastodon does. The
+stand-in Anthropic API answers every request with a short unique reply
+and counts input tokens as request bytes / 4.
+
+For each path it reports the median wall time of main(), API calls, body
+bytes in and out, and the tokens sent to and returned by the model.
+
+--personas N runs N copies of the first persona in personas.json side by
+side, each with its own state, to see how a run scales with personas.
+
+Usage: python benchmarks/endtoend.py [--runs N] [--latency MS]
+       [--llm-latency MS] [--followers N] [--paths post,reply,...]
+       [--personas N] [--routes]
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+with open(os.path.join(ROOT, "personas.json")) as f:
+    PERSONA = json.load(f)[0]
+
+BOT_ID = PERSONA["bot_id"]
+SOURCE_ID = PERSONA["source_id"]
+LILT_ID = PERSONA["lilt"]["id"]
+
+PATHS = {
+    "idle": [],
+    "post": ["post"],
+    "reply": ["reply", "fave"],
+    "boost": ["boost"],
+    "commentary": ["commentary"],
+    "source_reply": ["source_reply"],
+    "follow": ["follow"],
+    "follower_reply": ["follower_reply"],
+    "review": ["review"],
+    "count": ["count"],
+    "all": ["post", "reply", "fave", "boost", "commentary", "source_reply",
+            "follow", "follower_reply", "review", "count"],
+}
+
+CHILD = """
+import datetime as dt
+import json
+import os
+import time
+
+import local_settings
+
+tmp = os.environ["BENCH_TMP"]
+local_settings.DEBUG = False
+local_settings.PERSONAS_PATH = os.path.join(tmp, "personas.json")
+local_settings.STATE_PATH = os.path.join(tmp, "{persona}_state.sqlite3")
+local_settings.STATE_S3_BUCKET = None
+local_settings.DEDUPE_PATH = os.path.join(tmp, "{persona}_dedupe.pickle")
+local_settings.ACTIVITY_CACHE_PATH = os.path.join(tmp, "{persona}_activity.json")
+local_settings.POST_QUEUE_PATH = os.path.join(tmp, "{persona}_post_queue.json")
+
+import ebooks
+
+class Noon(dt.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return dt.datetime.now(tz).replace(hour=12, minute=0)
+
+forced = set(filter(None, os.environ["BENCH_FORCE"].split(",")))
+ebooks.datetime = Noon
+ebooks.roll = lambda feature, odds: 0 if feature in forced else 1
+
+start = time.perf_counter()
+ebooks.main()
+print(json.dumps({"wall": time.perf_counter() - start}))
+"""
+
+
+def iso(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def account(id, acct, bot=False):
+    return {
+        "id": str(id), "username": acct, "acct": acct, "display_name": acct,
+        "locked": False, "bot": bot, "discoverable": True, "group": False,
+        "created_at": "2020-01-01T00:00:00.000Z", "note": "",
+        "url": f"https://mastodon.example/@{acct}", "avatar": "", "avatar_static": "",
+        "header": "", "header_static": "", "followers_count": 0, "following_count": 0,
+        "statuses_count": 0, "last_status_at": None, "emojis": [], "fields": [],
+    }
+
+
+def status(id, author, text, created, in_reply_to=None, reblog=None):
+    return {
+        "id": str(id), "created_at": iso(created), "edited_at": None,
+        "in_reply_to_id": None if in_reply_to is None else in_reply_to["id"],
+        "in_reply_to_account_id": None if in_reply_to is None else in_reply_to["account"]["id"],
+        "sensitive": False, "spoiler_text": "", "visibility": "public", "language": "en",
+        "uri": f"https://mastodon.example/users/{author['acct']}/statuses/{id}",
+        "url": f"https://mastodon.example/@{author['acct']}/{id}",
+        "replies_count": 0, "reblogs_count": 0, "favourites_count": 0,
+        "favourited": False, "reblogged": False, "muted": False, "bookmarked": False,
+        "content": f"<p>{escape(text)}</p>", "reblog": reblog, "account": author,
+        "media_attachments": [], "mentions": [], "tags": [], "emojis": [],
+        "card": None, "poll": None,
+    }
+
+
+class Fixtures:
+    """Everything the stand-in Mastodon serves. Rebuilt before each run."""
+
+    def __init__(self, followers):
+        with open(os.path.join(ROOT, "voice_samples.json")) as f:
+            samples = json.load(f)
+        with open(os.path.join(ROOT, "example_tweet.json")) as f:
+            mention_text = json.load(f)["full_text"]
+
+        now = datetime.now(timezone.utc)
+        ids = itertools.count(110000000000000000)
+        self.ids = ids
+        self.now = now
+        self.bot = account(BOT_ID, "robot_mk", bot=True)
+        self.source = account(SOURCE_ID, "mknepprath")
+        self.lilt = account(LILT_ID, "familiarlilt", bot=True)
+        self.accounts = {BOT_ID: self.bot, SOURCE_ID: self.source, LILT_ID: self.lilt}
+
+        # Oldest first while building; timelines are served newest first
+        self.timelines = {}
+        source = []
+        for i, text in enumerate(samples[:400]):
+            created = now - timedelta(days=3, minutes=400 - i)
+            reply_to = source[-1] if i % 5 == 4 else None
+            source.append(status(next(ids), self.source, text, created, reply_to))
+        self.timelines[SOURCE_ID] = source
+
+        bot_posts = []
+        for i, text in enumerate(samples[400:450]):
+            bot_posts.append(status(next(ids), self.bot, text, now - timedelta(days=2, minutes=50 - i)))
+        self.timelines[BOT_ID] = bot_posts
+
+        for bot_id in ["109447224294183229", "109852410462840995", "113479454947259743",
+                       "113490843400044713"]:
+            sibling = account(bot_id, f"bot{bot_id[-4:]}", bot=True)
+            self.accounts[bot_id] = sibling
+            self.timelines[bot_id] = [
+                status(next(ids), sibling, f"Card #{n}: a very shiny one https://example.com/{bot_id}/{n}",
+                       now - timedelta(hours=6 - n))
+                for n in range(5)
+            ]
+        self.timelines[LILT_ID] = [
+            status(next(ids), self.lilt, "You are in a dark room. Exits: north.",
+                   now - timedelta(hours=1), in_reply_to=bot_posts[-1]),
+        ]
+
+        # A mention replying to one of our posts, so the thread needs context
+        fan = account(900000000, "fan")
+        self.accounts[fan["id"]] = fan
+        mention = status(next(ids), fan, mention_text, now - timedelta(minutes=30), in_reply_to=bot_posts[-1])
+        self.statuses = {s["id"]: s for timeline in self.timelines.values() for s in timeline}
+        self.statuses[mention["id"]] = mention
+        self.notifications = [{
+            "id": str(next(ids)), "type": "mention", "created_at": mention["created_at"],
+            "account": fan, "status": mention,
+        }]
+
+        # Newest follower first; most of them we already follow back
+        people = [account(800000000 + n, f"person{n}") for n in range(followers)]
+        for person in people:
+            self.accounts[person["id"]] = person
+            self.timelines[person["id"]] = [
+                status(next(ids), person, f"Just had the best sandwich of my life, number {person['id']}",
+                       now - timedelta(hours=2)),
+            ]
+        self.followers = list(reversed(people))
+        self.following = [self.source] + list(reversed(people[: followers * 4 // 5]))
+        self.remaining = 300
+        self.reset = now + timedelta(minutes=5)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "StandIn/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def handle_any(self, method):
+        server = self.server
+        url = urlparse(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if body:
+            try:
+                params.update(json.loads(body))
+            except ValueError:
+                params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+
+        path = url.path.rstrip("/")
+        if path.startswith("/v1/messages"):
+            service, latency = "anthropic", server.llm_latency
+        elif path.startswith("/activity"):
+            service, latency = "feed", server.latency
+        else:
+            service, latency = "mastodon", server.latency
+        time.sleep(latency)
+
+        status_code, payload, headers = 200, None, {}
+        with server.lock:
+            route = f"{method} {path}"
+            if service == "anthropic":
+                payload = server.message(params)
+            elif service == "feed":
+                payload = server.activity
+            else:
+                route, status_code, payload, headers = server.mastodon(method, path, params)
+            data = json.dumps(payload).encode()
+            stats = server.stats[service]
+            stats["calls"] += 1
+            stats["bytes_in"] += len(body)
+            stats["bytes_out"] += len(data)
+            server.routes[f"{service} {route}"] += 1
+
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, llm_latency, followers):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.latency = latency
+        self.llm_latency = llm_latency
+        self.followers = followers
+        self.lock = threading.Lock()
+        self.replies = itertools.count()
+        self.activity = [
+            {"type": "FILM", "action": "Watched", "title": "Alien", "summary": ""},
+            {"type": "BOOK", "action": "Finished", "title": "Piranesi", "summary": ""},
+            {"type": "GAME", "action": "Played", "title": "Tetris", "summary": ""},
+        ]
+        self.reset()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def reset(self):
+        self.fixtures = Fixtures(self.followers)
+        self.stats = {service: Counter() for service in ("mastodon", "anthropic", "feed")}
+        self.routes = Counter()
+
+    def message(self, params):
+        n = next(self.replies)
+        words = ["oh", "nice", "heck", "yeah", "honestly", "neat", "wild", "same", "lol", "huh"]
+        text = " ".join(words[(n * 7 + i * 3) % len(words)] for i in range(3)) + f" {n}"
+        request_tokens = len(json.dumps(params)) // 4
+        output_tokens = len(text) // 4 + 1
+        self.stats["anthropic"]["input_tokens"] += request_tokens
+        self.stats["anthropic"]["output_tokens"] += output_tokens
+        return {
+            "id": f"msg_{n}", "type": "message", "role": "assistant", "model": params.get("model", ""),
+            "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": request_tokens, "output_tokens": output_tokens,
+                      "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0},
+        }
+
+    def mastodon(self, method, path, params):
+        fx = self.fixtures
+        fx.remaining = max(fx.remaining - 1, 0)
+        headers = {
+            "X-RateLimit-Limit": "300",
+            "X-RateLimit-Remaining": str(fx.remaining),
+            "X-RateLimit-Reset": iso(fx.reset),
+        }
+        parts = path.split("/")[3:]  # after /api/v1
+        limit = int(params.get("limit", 20))
+
+        if parts[:1] == ["instance"]:
+            return "GET instance", 200, {"uri": "mastodon.example", "title": "Stand-in", "version": "4.2.0"}, headers
+
+        if parts[:1] == ["accounts"] and len(parts) == 2:
+            account = dict(fx.accounts[parts[1]])
+            if parts[1] == BOT_ID:
+                account["followers_count"] = len(fx.followers)
+                account["following_count"] = len(fx.following)
+            return "GET accounts/:id", 200, account, headers
+
+        if parts[:1] == ["accounts"] and parts[2] == "statuses":
+            timeline = list(reversed(fx.timelines.get(parts[1], [])))
+            if params.get("exclude_replies") in ("true", "1", True):
+                timeline = [s for s in timeline if s["in_reply_to_id"] is None]
+            return "GET accounts/:id/statuses", 200, page(timeline, params, limit), headers
+
+        if parts[:1] == ["accounts"] and parts[2] in ("followers", "following"):
+            accounts = fx.followers if parts[2] == "followers" else fx.following
+            start = int(params.get("max_id", 0))
+            chunk = accounts[start:start + limit]
+            if start + limit < len(accounts):
+                query = urlencode({"limit": limit, "max_id": start + limit})
+                headers["Link"] = f'<{self.url}{path}?{query}>; rel="next"'
+            return f"GET accounts/:id/{parts[2]}", 200, chunk, headers
+
+        if parts[:1] == ["accounts"] and parts[2] in ("follow", "unfollow"):
+            target = fx.accounts[parts[1]]
+            if parts[2] == "follow":
+                fx.following.insert(0, target)
+            else:
+                fx.following = [a for a in fx.following if a["id"] != target["id"]]
+            relationship = {"id": target["id"], "following": parts[2] == "follow", "requested": False,
+                            "followed_by": True, "blocking": False, "muting": False}
+            return f"POST accounts/:id/{parts[2]}", 200, relationship, headers
+
+        if parts == ["notifications"]:
+            return "GET notifications", 200, page(list(reversed(fx.notifications)), params, limit), headers
+
+        if parts == ["statuses"] and method == "POST":
+            reply_to = fx.statuses.get(str(params.get("in_reply_to_id")))
+            posted = status(next(fx.ids), fx.bot, params.get("status", ""), datetime.now(timezone.utc), reply_to)
+            fx.statuses[posted["id"]] = posted
+            fx.timelines[BOT_ID].append(posted)
+            return "POST statuses", 200, posted, headers
+
+        if parts[:1] == ["statuses"] and len(parts) == 3:
+            target = fx.statuses[parts[1]]
+            if parts[2] == "context":
+                ancestors = []
+                parent = fx.statuses.get(str(target["in_reply_to_id"]))
+                while parent:
+                    ancestors.insert(0, parent)
+                    parent = fx.statuses.get(str(parent["in_reply_to_id"]))
+                return "GET statuses/:id/context", 200, {"ancestors": ancestors, "descendants": []}, headers
+            if parts[2] == "reblog":
+                boosted = status(next(fx.ids), fx.bot, "", datetime.now(timezone.utc), reblog=target)
+                fx.timelines[BOT_ID].append(boosted)
+                return "POST statuses/:id/reblog", 200, boosted, headers
+            return f"POST statuses/:id/{parts[2]}", 200, dict(target, **{f"{parts[2]}d": True}), headers
+
+        return f"{method} {path}", 404, {"error": "Record not found"}, headers
+
+
+def page(items, params, limit):
+    """Slice a newest-first list the way Mastodon's max_id/min_id/since_id do."""
+    def after(key):
+        return [s for s in items if int(s["id"]) > int(params[key])]
+
+    if params.get("max_id"):
+        items = [s for s in items if int(s["id"]) < int(params["max_id"])]
+    if params.get("since_id"):
+        items = after("since_id")
+    if params.get("min_id"):
+        return after("min_id")[-limit:]
+    return items[:limit]
+
+
+def run_path(server, force, tmp, personas=1):
+    # Copies of the first persona, all reading the stand-in's activity feed
+    with open(os.path.join(tmp, "personas.json"), "w") as f:
+        json.dump([dict(PERSONA, name=f"{PERSONA['name']}_{i}" if i else PERSONA["name"],
+                        activity_url=f"{server.url}/activity")
+                   for i in range(personas)], f)
+    env = dict(
+        os.environ,
+        BENCH_TMP=tmp,
+        BENCH_FORCE=",".join(force),
+        MASTODON_API_BASE_URL=server.url,
+        MASTODON_ACCESS_TOKEN="bench",
+        ANTHROPIC_BASE_URL=server.url,
+        ANTHROPIC_API_KEY="bench",
+    )
+    out = subprocess.run([sys.executable, "-c", CHILD], cwd=ROOT, env=env,
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f"{force}: main() failed\n{out.stdout[-2000:]}\n{out.stderr[-2000:]}")
+    return json.loads(out.stdout.strip().splitlines()[-1])["wall"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=30, help="Mastodon/feed latency, ms")
+    parser.add_argument("--llm-latency", type=float, default=300, help="Anthropic latency, ms")
+    parser.add_argument("--followers", type=int, default=500)
+    parser.add_argument("--paths", default=",".join(PATHS))
+    parser.add_argument("--personas", type=int, default=1, help="copies of the first persona to run")
+    parser.add_argument("--routes", action="store_true", help="also print calls per endpoint")
+    args = parser.parse_args()
+
+    server = StandInServer(args.latency / 1000, args.llm_latency / 1000, args.followers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    print(f"{'path':>15} {'wall ms':>9} {'masto':>6} {'llm':>4} {'feed':>4} "
+          f"{'bytes out':>10} {'bytes in':>10} {'tok in':>8} {'tok out':>7}")
+    for name in args.paths.split(","):
+        walls = []
+        for _ in range(args.runs):
+            server.reset()
+            with tempfile.TemporaryDirectory() as tmp:
+                walls.append(run_path(server, PATHS[name], tmp, args.personas))
+        stats = server.stats
+        sent = sum(s["bytes_in"] for s in stats.values())
+        received = sum(s["bytes_out"] for s in stats.values())
+        print(f"{name:>15} {statistics.median(walls) * 1000:9.1f} {stats['mastodon']['calls']:6d} "
+              f"{stats['anthropic']['calls']:4d} {stats['feed']['calls']:4d} {sent:10d} {received:10d} "
+              f"{stats['anthropic']['input_tokens']:8d} {stats['anthropic']['output_tokens']:7d}")
+        if args.routes:
+            for route, count in sorted(server.routes.items()):
+                print(f"{'':>17}{count:4d}  {route}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+HTML-to-text micro-benchmark: the old per-status HTMLFilter against
+ebooks.html_to_text and the memoized ebooks.status_text.
+
+Each batch is get_posts-sized (200 statuses) and mixes short posts, mentions,
+links and entities with a few long multi-paragraph ones.
+
+Usage: python benchmarks/html_to_text.py [batches]
+"""
+import os
+import random
+import sys
+import timeit
+from html.parser import HTMLParser
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ebooks  # noqa: E402
+
+
+class HTMLFilter(HTMLParser):
+    """The converter ebooks.py used before html_to_text."""
+    text = ""
+
+    def handle_data(self, data):
+        self.text += data
+
+
+def old_convert(status):
+    f = HTMLFilter()
+    f.feed(status.content)
+    return f.text
+
+
+def make_status(i, rng):
+    words = ["heck", "yeah", "film", "letterboxd", "pokemon", "ope", "sooo", "good", "site", "design"]
+    paragraphs = rng.choice([1, 1, 1, 2, 3, 40])
+    body = "".join(
+        "<p>"
+        + " ".join(rng.choice(words) for _ in range(rng.randint(3, 30)))
+        + ' <span class="h-card"><a href="https://mastodon.social/@x" class="u-url mention">@<span>x</span></a></span>'
+        + ' &amp; <a href="https://mknepprath.com" rel="nofollow"><span class="invisible">https://</span>'
+        + '<span class="">mknepprath.com</span></a> it&#39;s<br>fine</p>'
+        for _ in range(paragraphs)
+    )
+    return SimpleNamespace(id=str(i), content=body)
+
+
+def main():
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rng = random.Random(0)
+    statuses = [make_status(i, rng) for i in range(200)]
+
+    def old():
+        return [old_convert(s) for s in statuses]
+
+    def new():
+        return [ebooks.html_to_text(s.content) for s in statuses]
+
+    def memoized():
+        return [ebooks.status_text(s) for s in statuses]
+
+    memoized()  # warm the memo, as a second pass over the same statuses in one run would be
+    for name, fn in [("HTMLFilter", old), ("html_to_text", new), ("status_text (memo hit)", memoized)]:
+        seconds = min(timeit.repeat(fn, number=batches, repeat=3)) / batches
+        print(f"{name:>24}: {seconds * 1000:7.2f} ms per 200 statuses")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Rerun a recorded invocation of ebooks.main() offline, optionally profiled.
+
+Record one by setting ROBOT_MK_CASSETTE to a file path before a run (see
+cassette.py). Replaying restores the state files the run started from into
+a temporary directory, then runs main() with the recorded clock, random
+seed and HTTP responses, so it takes the same path with no network.
+
+--profile cprofile prints the functions with the most time under them
+(--sort, --limit), or writes the stats to --out for snakeviz and friends.
+Worker threads (the concurrent fetches and generations) are profiled too.
+--profile pyinstrument prints pyinstrument's call tree, or writes its HTML
+report to --out; it only samples the main thread.
+
+Usage: python benchmarks/replay.py CASSETTE [--profile cprofile|pyinstrument]
+       [--sort cumtime] [--limit 40] [--out FILE]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def prepare(path, tmp):
+    """Point the bot at `tmp` and load the cassette. Before ebooks is imported."""
+    import local_settings
+
+    recorded = {
+        name: getattr(local_settings, name)
+        for name in ("STATE_PATH", "DEDUPE_PATH", "ACTIVITY_CACHE_PATH", "POST_QUEUE_PATH")
+    }
+    for name, value in recorded.items():
+        setattr(local_settings, name, os.path.join(tmp, os.path.basename(value)))
+    local_settings.STATE_S3_BUCKET = None
+
+    import cassette
+    import persona
+
+    tape = cassette.load(path)
+    # Paths are per persona (see persona.py)
+    cassette.restore({me.path(value): me.path(getattr(local_settings, name))
+                      for me in persona.load() for name, value in recorded.items()})
+
+    # Requests are matched on full URLs, so talk to the servers that were recorded
+    for exchange in reversed(tape["exchanges"]):
+        if "/api/v" in exchange["url"]:
+            os.environ["MASTODON_API_BASE_URL"] = exchange["url"].split("/api/v")[0]
+        elif exchange["url"].endswith("/v1/messages"):
+            os.environ["ANTHROPIC_BASE_URL"] = exchange["url"][:-len("/v1/messages")]
+    for name in ("MASTODON_CLIENT_KEY", "MASTODON_CLIENT_SECRET", "MASTODON_ACCESS_TOKEN", "ANTHROPIC_API_KEY"):
+        os.environ.setdefault(name, "replay")
+    return tape
+
+
+def run_cprofile(main, args):
+    import cProfile
+    import pstats
+
+    profiles = [cProfile.Profile()]
+
+    def profile_thread(*_):
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        profile.enable()
+
+    threading.setprofile(profile_thread)
+    profiles[0].enable()
+    try:
+        main()
+    finally:
+        profiles[0].disable()
+        threading.setprofile(None)
+
+    stats = pstats.Stats(*profiles)
+    if args.out:
+        stats.dump_stats(args.out)
+        print(f"Wrote profile to {args.out}")
+    else:
+        stats.sort_stats(args.sort).print_stats(args.limit)
+
+
+def run_pyinstrument(main, args):
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        sys.exit("pyinstrument isn't installed (pip install pyinstrument)")
+
+    profiler = Profiler()
+    profiler.start()
+    try:
+        main()
+    finally:
+        profiler.stop()
+
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(profiler.output_html())
+        print(f"Wrote profile to {args.out}")
+    else:
+        print(profiler.output_text(unicode=True, color=sys.stdout.isatty()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("cassette")
+    parser.add_argument("--profile", choices=("cprofile", "pyinstrument"))
+    parser.add_argument("--sort", default="cumtime", help="cProfile sort key")
+    parser.add_argument("--limit", type=int, default=40, help="cProfile rows to print")
+    parser.add_argument("--out", help="write the profile here instead of printing it")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tape = prepare(args.cassette, tmp)
+        print(f"Replaying {len(tape['exchanges'])} requests recorded at {tape['now']}")
+
+        import ebooks
+
+        start = time.perf_counter()
+        if args.profile == "cprofile":
+            run_cprofile(ebooks.main, args)
+        elif args.profile == "pyinstrument":
+            run_pyinstrument(ebooks.main, args)
+        else:
+            ebooks.main()
+        print(f"main() took {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        unused = [e for e in tape["exchanges"] if not e.get("used")]
+        if unused:
+            print(f"{len(unused)} recorded requests weren't replayed:")
+            for exchange in unused:
+                print(f"  {exchange['method']} {exchange['url']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Record and replay of everything a run takes from outside the process.
+
+Run with ROBOT_MK_CASSETTE=/tmp/run.cassette and main() records:
+
+- the clock reading it decides the hour and day from
+- a fresh seed for `random`, which every roll and shuffle comes from
+- the state files each persona starts from (state, near-duplicate index, feed cache,
+  post queue)
+- every HTTP request and response, Mastodon, feed and Anthropic alike,
+  captured at the transports in http_pool.py
+
+It's written as gzipped JSON when the run ends, and uploaded to S3 under
+cassettes/ when STATE_S3_BUCKET is set, so production runs can be pulled
+down. `python benchmarks/replay.py CASSETTE` reruns main() against it with
+no network, optionally under a profiler.
+
+Replayed requests are matched on method, URL and body, oldest recording
+first, so concurrent requests can come back in any order. A run recorded
+on a warm container may have answered some reads from memory that a fresh
+replay process asks for again. Those get a connection error, the same as
+a failed request in production.
+"""
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+from local_settings import *
+
+MODE = None  # None, 'record' or 'replay'
+PATH = None
+
+_lock = threading.Lock()
+_tape = None
+_replies = None  # request key -> deque of recorded responses
+
+
+def _key(method, url, body):
+    digest = hashlib.sha1(body or b'').hexdigest()
+    return f'{method} {url} {digest}'
+
+
+def begin():
+    """Start recording if ROBOT_MK_CASSETTE is set. Called by main()."""
+    global MODE, PATH, _tape
+    path = os.environ.get('ROBOT_MK_CASSETTE')
+    if MODE == 'replay' or not path:
+        return
+    MODE, PATH = 'record', path
+    _tape = {'recorded_at': time.time(), 'now': None, 'seed': None, 'files': {}, 'exchanges': []}
+
+
+def load(path):
+    """Switch to replay mode with the cassette at `path`. Returns it."""
+    global MODE, PATH, _tape, _replies
+    import gzip
+
+    with gzip.open(path, 'rt') as f:
+        _tape = json.load(f)
+    MODE, PATH = 'replay', path
+    _replies = defaultdict(deque)
+    for exchange in _tape['exchanges']:
+        _replies[exchange['key']].append(exchange)
+        _replies[exchange['method'] + ' ' + exchange['url']].append(exchange)
+    return _tape
+
+
+def clock(now):
+    """The run's `now`: recorded as-is, or replaced by the recorded one."""
+    if MODE == 'record':
+        _tape['now'] = now.isoformat()
+    elif MODE == 'replay':
+        return datetime.fromisoformat(_tape['now'])
+    return now
+
+
+def seed_random():
+    if MODE == 'record':
+        _tape['seed'] = int.from_bytes(os.urandom(8), 'big')
+    if MODE is not None:
+        random.seed(_tape['seed'])
+
+
+def snapshot(paths):
+    """Keep the starting contents of each of `paths` that exists."""
+    if MODE != 'record':
+        return
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                data = base64.b64encode(f.read()).decode()
+        except OSError:
+            continue
+        with _lock:
+            _tape['files'][path] = data
+
+
+def restore(paths):
+    """Write recorded files into `paths` ({recorded path: new path})."""
+    for old, new in paths.items():
+        data = _tape['files'].get(old)
+        if data is not None:
+            with open(new, 'wb') as f:
+                f.write(base64.b64decode(data))
+
+
+def record(method, url, body, status, headers, content):
+    if isinstance(body, str):
+        body = body.encode()
+    # Bodies are stored decoded, so the encoding headers no longer apply
+    headers = {k: v for k, v in headers.items()
+               if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding')}
+    with _lock:
+        _tape['exchanges'].append({
+            'key': _key(method, url, body),
+            'method': method,
+            'url': url,
+            'status': status,
+            'headers': headers,
+            'content': base64.b64encode(content).decode(),
+        })
+
+
+def reply(method, url, body):
+    """(status, headers, content) recorded for this request, or None."""
+    if isinstance(body, str):
+        body = body.encode()
+    with _lock:
+        for key in (_key(method, url, body), f'{method} {url}'):
+            queue = _replies.get(key)
+            while queue:
+                exchange = queue.popleft()
+                if not exchange.get('used'):
+                    exchange['used'] = True
+                    return exchange['status'], exchange['headers'], base64.b64decode(exchange['content'])
+    return None
+
+
+def save():
+    if MODE != 'record':
+        return
+    import gzip
+
+    with gzip.open(PATH, 'wt') as f:
+        json.dump(_tape, f)
+    print(f'Recorded {len(_tape["exchanges"])} requests to {PATH}')
+    if STATE_S3_BUCKET:
+        try:
+            import boto3
+
+            key = f'cassettes/{time.strftime("%Y%m%dT%H%M%S")}-{os.path.basename(PATH)}'
+            boto3.client('s3').upload_file(PATH, STATE_S3_BUCKET, key)
+            print(f'Uploaded cassette to s3://{STATE_S3_BUCKET}/{key}')
+        except Exception as e:
+            print(f'Error uploading cassette: {e}')
@@ -0,0 +1,131 @@
+"""
+Near-duplicate detection for generated posts.
+
+Every text is reduced to its set of character 4-grams (after lowercasing
+and dropping links, mentions and punctuation) and kept in an inverted index
+from shingle to text. Scoring uses prefix filtering: anything at least
+`threshold` similar to a candidate must share one of the candidate's rarest
+few shingles, so only those short posting lists are walked before computing
+exact Jaccard similarity for the texts they point to. A check takes well
+under a millisecond and grows with the candidate's length, not the archive's.
+
+The index holds the voice samples and the bot's own recent posts. The voice
+sample part is built at package time (`build`, run by deploy.sh through
+persona.py), so a cold start only loads it and adds the recent posts. New
+posts are added as they go out, and the whole thing is pickled to
+DEDUPE_PATH so a warm container (or the next run on the same one) picks up
+where it left off.
+"""
+import json
+import math
+import os
+import pickle
+import re
+
+SHINGLE_SIZE = 4
+
+NOISE_RE = re.compile(r'https?://\S+|@\S+')
+NON_WORD_RE = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(text):
+    return NON_WORD_RE.sub(' ', NOISE_RE.sub(' ', text.lower())).strip()
+
+
+def shingles(text):
+    text = normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+class NearDuplicateIndex:
+    def __init__(self, max_recent=200):
+        self.max_recent = max_recent
+        self.sets = {}  # key -> frozenset of shingles
+        self.postings = {}  # shingle -> set of keys
+        self.recent = []  # keys of the bot's own posts, oldest first
+        self.dirty = False
+
+    def __contains__(self, key):
+        return key in self.sets
+
+    def add(self, key, text):
+        """Index `text` under `key`. Adding a key that's already there is a no-op."""
+        if key in self.sets:
+            return
+        grams = shingles(text)
+        if not grams:
+            return
+        self.sets[key] = frozenset(grams)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(key)
+        self.dirty = True
+
+    def add_recent(self, text):
+        """Index one of the bot's own posts, forgetting the oldest past max_recent."""
+        key = ('post', normalize(text))
+        if key in self.sets:
+            return
+        self.add(key, text)
+        self.recent.append(key)
+        while len(self.recent) > self.max_recent:
+            self.remove(self.recent.pop(0))
+
+    def remove(self, key):
+        grams = self.sets.pop(key, None)
+        if grams is None:
+            return
+        for gram in grams:
+            self.postings[gram].discard(key)
+        self.dirty = True
+
+    def similarity(self, text, threshold=0.5):
+        """Highest Jaccard similarity between `text` and anything indexed.
+
+        Exact whenever the answer is at least `threshold`. Below that it only
+        considers texts sharing one of the prefix shingles, so it can come in
+        low, which is fine for ranking.
+        """
+        grams = shingles(text)
+        if not grams:
+            return 0.0
+        rarest = sorted(grams, key=lambda gram: len(self.postings.get(gram, ())))
+        prefix = len(grams) - math.ceil(threshold * len(grams)) + 1
+        candidates = set()
+        for gram in rarest[:prefix]:
+            candidates.update(self.postings.get(gram, ()))
+        best = 0.0
+        for key in candidates:
+            other = self.sets[key]
+            shared = len(grams & other)
+            best = max(best, shared / (len(grams) + len(other) - shared))
+        return best
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self.dirty = False
+
+
+def build(json_path, path):
+    """Index the voice samples in the `json_path` archive and pickle it to `path`."""
+    with open(json_path, 'r') as f:
+        samples = json.load(f)
+    index = NearDuplicateIndex()
+    for i, sample in enumerate(samples):
+        index.add(('voice', i), sample)
+    index.save(path)
+    return len(index.sets)
+
+
+def load(path):
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+        index.dirty = False
+        return index
+    except Exception:
+        return None
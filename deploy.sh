@@ -10,8 +10,15 @@ mkdir -p bundle
 # Bundle the dependencies for the correct platform architecture
 pip install --target bundle -r requirements.txt --platform manylinux2014_x86_64 --python-version 3.9 --only-binary=:all: --upgrade
 
+# Pack each persona's voice samples for random access and build their retrieval
+# indexes (needs numpy locally; see persona.py, voice_store.py and voice_index.py)
+python persona.py build bundle
+
 # Add function code to bundle in one step
-cp {ebooks.py,lambda_function.py,local_settings.py,voice_samples.json} bundle/
+cp {activity_feed.py,cassette.py,dedupe.py,ebooks.py,engine.py,follows.py,http_pool.py,lambda_function.py,local_settings.py,mastodon_client.py,metrics.py,persona.py,planner.py,post_queue.py,state.py,voice_index.py,voice_store.py,warm_cache.py} bundle/
+
+# The personas and their system prompts
+cp -r personas.json prompts bundle/
 
 # Zip the bundle
 (cd bundle && zip -r ../bundle.zip .)
@@ -1,149 +1,201 @@
+import contextvars
 import os
 import random
 import re
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
-from html.parser import HTMLParser
-
-from mastodon import Mastodon
-import anthropic
-import json
-from urllib.request import urlopen
-
-client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+from html import unescape
+
+import activity_feed
+import cassette
+import dedupe
+import engine
+import follows
+import http_pool
+import metrics
+import persona
+import planner
+import post_queue
+from mastodon_client import CachedMastodon, Deferred, RateLimitScheduler, cache_type_hints
+from post_queue import PostQueue
+from state import StateStore
+import voice_index
+import voice_store
 
 from local_settings import *
 
+# The Mastodon and Anthropic SDKs, the Anthropic client and the voice samples
+# are all loaded on first use. Most hourly runs are asleep or do nothing, and
+# shouldn't pay for them at cold start. Every persona shares the one client,
+# and personas with the same archive share its samples and index.
+_client = None
+_voice_lock = threading.Lock()
+_voice_samples = {}  # archive path -> samples
+_voice_indexes = {}  # index path -> VoiceIndex, or None if it didn't load
+_duplicate_indexes = {}  # persona name -> NearDuplicateIndex
+_duplicate_lock = threading.RLock()
+_unindexed_posts = {}  # persona name -> its posts not in the index yet
+
 # US Eastern timezone
 ET = timezone(timedelta(hours=-4))  # EDT; change to -5 for EST
 
-SYSTEM_PROMPT = """You are a bot that posts as Michael Knepprath's doppelganger on Mastodon.
-
-VOICE — study these rules carefully:
-- Lowercase almost always. Capitalize proper nouns and sentence starts only sometimes.
-- Short. Most posts are one sentence, sometimes just a few words or a single emoji.
-- Dry, deadpan humor. Understated. Never wacky, quirky, or "relatable tech person."
-- Midwestern sensibility. Occasional "ope", "heck yeah", drawn-out vowels like "sooo" or "gooood" for emphasis.
-- No hashtags. No links. No quotes around the post text.
-- Never swears. Says "heck" not "hell."
-- Topics he actually cares about: films (especially older/classic ones, letterboxd culture), design, side projects, iOS apps, Nintendo, Pokemon GO, music, family life.
-- Sometimes just vibes: a single emoji, a short observation, a fragment.
-- NEVER write about: coffee culture, sourdough, CSS bugs, houseplants, "adulting," or any generic internet humor tropes.
-- Don't be try-hard funny. The humor comes from being genuine and terse.
-- No em dashes.
-
-CONTEXT about Michael:
-- Lives in Northeast Ohio with his wife, kid, and two cats.
-- Works as a software engineer / designer.
-- Runs a personal site at mknepprath.com (Next.js). Constantly tinkering with it.
-- Built lily dex, a Pokemon GO companion iOS app (SwiftUI). Plays Pokemon GO actively.
-- Runs a film blog called Tardy Critic where he reviews movies 10 years late.
-- Active Letterboxd user. Watches a LOT of movies — classic, indie, blockbusters, horror, anime, Ghibli, Wes Anderson, etc.
-- Runs regularly (Strava user). Into hiking.
-- Plays chess on Chess.com.
-- Games on PS5 and Steam.
-- Listens to a wide range of music.
-- Grew up in Wisconsin (hence the Midwestern sensibility).
-- Has a bot doppelganger called @robot_mk (that's you).
-- Previously very active on Twitter before migrating to Mastodon/Bluesky.
-- Interested in design systems, typography, illustration, pixel art.
-
-STRUCTURAL RULES — these are critical:
-- NO punchlines. NO setups. NO "X? more like Y" constructions.
-- NO internet slang he doesn't use: "go off", "I said what I said", "and I took that personally", "it's giving", "no cap", "rent free", "understood the assignment"
-- NO constructed jokes. The humor is accidental, not engineered.
-- Posts should feel like something muttered, not performed.
-- If it sounds like a tweet that's trying to go viral, delete it and start over.
-
-GOOD examples of his voice:
-- I am obsessed with Hoppers
-- with every social media clone I join my power grows
-- btw there is no such thing as an Oscar loss. being nominated is itself an honor
-- 😮‍💨
-- bored with my website; making a change
-- heck yeah
-- new rule: if a movie is over 2.5 hours it better have an intermission
-- the mass migration from twitter continues
-- not doing Hive sorry
-- sure am getting a lot more twitter spam starting about a week ago
-- .grid { display: flex; ... } 😑
-- love this movie sooo much
-
-BAD examples (DO NOT write like this):
-- "spent the morning wrestling with a stubborn line of code"
-- "discovered a new coffee shop today"
-- "been pondering the existential crisis of my houseplants"
-- anything with a setup-punchline story structure
-- "budget constraints? more like budget genius" (this is a constructed joke)
-- "but go off i guess" (internet slang he doesn't use)
-- anything that builds to a clever turn or reversal"""
-
-
-ACTIVITY_URL = "https://mknepprath.com/api/v1/activity?max_results=30&min_rating=0"
-
-# Load voice samples from Twitter archive
-VOICE_SAMPLES = []
-try:
-    voice_path = os.path.join(os.path.dirname(__file__), 'voice_samples.json')
-    with open(voice_path, 'r') as f:
-        VOICE_SAMPLES = json.load(f)
-    print(f'Loaded {len(VOICE_SAMPLES)} voice samples')
-except Exception:
-    print('No voice samples found')
-
-
-def fetch_activity_feed():
-    """Fetch recent activity from mknepprath.com and format as context."""
-    try:
-        with urlopen(ACTIVITY_URL) as response:
-            data = json.loads(response.read().decode())
-
-        # Skip toots/skeets (already in Mastodon posts), repos (noisy), and robot posts (that's us)
-        skip_types = {"TOOT", "SKEET", "REPO", "ROBOT"}
-        items = [item for item in data if item.get("type") not in skip_types]
-
-        lines = []
-        for item in items[:20]:
-            action = item.get("action", "Did something with")
-            title = item.get("title", "").replace("&#39;", "'").replace("&amp;", "&")
-            summary = item.get("summary", "")
-            item_type = item.get("type", "")
-
-            if item_type == "FILM":
-                lines.append(f"- {action} the film: {title}")
-            elif item_type == "BOOK":
-                lines.append(f"- {action} the book: {title}")
-            elif item_type == "MUSIC":
-                artist = summary if summary else ""
-                lines.append(f"- {action}: {title}" + (f" by {artist}" if artist else ""))
-            elif item_type == "RUN":
-                lines.append(f"- {action}: {title} ({summary})")
-            elif item_type == "TROPHY":
-                lines.append(f"- {action} trophy: {title}")
-            elif item_type == "CHESS":
-                lines.append(f"- Chess: {action} {title}")
-            elif item_type == "HIGHLIGHT":
-                lines.append(f"- Highlighted: \"{title[:80]}\" — {summary}")
-            elif item_type == "POST":
-                lines.append(f"- Wrote a blog post: {title}")
-            elif item_type == "GAME":
-                lines.append(f"- {action}: {title}")
-            elif item_type == "PHOTO":
-                lines.append(f"- Shared a photo")
-            else:
-                lines.append(f"- {action}: {title}")
+MODEL = "claude-haiku-4-5-20251001"
 
-        return "\n".join(lines)
-    except Exception as e:
-        print(f"Error fetching activity feed: {e}")
-        return ""
+FETCH_TIMEOUT = 20  # seconds, per fetch in main()'s concurrent I/O stage
 
+SOURCE_PAGE_SIZE = 40  # Mastodon's maximum statuses per page
 
-class HTMLFilter(HTMLParser):
-    text = ""
 
-    def handle_data(self, data):
-        self.text += data
+def get_client():
+    global _client
+    if _client is None:
+        import anthropic
+
+        _client = anthropic.Anthropic(
+            api_key=os.environ.get("ANTHROPIC_API_KEY"),
+            http_client=http_pool.anthropic_http_client(),
+        )
+    return _client
+
+
+def get_voice_samples():
+    """The current persona's voice samples from its archive, loaded on first use.
+
+    Prefers the memory-mapped .bin (see voice_store.py) and falls back to
+    parsing the JSON archive.
+    """
+    me = persona.current()
+    with _voice_lock:
+        samples = _voice_samples.get(me.voice_samples)
+        if samples is None:
+            samples = []
+            try:
+                samples = voice_store.load(me.voice_store, me.voice_samples)
+                print(f'Loaded {len(samples)} voice samples')
+            except Exception:
+                print('No voice samples found')
+            _voice_samples[me.voice_samples] = samples
+    return samples
+
+
+def format_activity(items):
+    """Render activity feed records as prompt context, one line per item."""
+    # Skip toots/skeets (already in Mastodon posts), repos (noisy), and robot posts (that's us)
+    skip_types = {"TOOT", "SKEET", "REPO", "ROBOT"}
+    items = [item for item in items if item.type not in skip_types]
+
+    lines = []
+    for item in items[:20]:
+        action = item.action or "Did something with"
+        title = item.title
+        summary = item.summary
+        item_type = item.type
+
+        if item_type == "FILM":
+            lines.append(f"- {action} the film: {title}")
+        elif item_type == "BOOK":
+            lines.append(f"- {action} the book: {title}")
+        elif item_type == "MUSIC":
+            artist = summary if summary else ""
+            lines.append(f"- {action}: {title}" + (f" by {artist}" if artist else ""))
+        elif item_type == "RUN":
+            lines.append(f"- {action}: {title} ({summary})")
+        elif item_type == "TROPHY":
+            lines.append(f"- {action} trophy: {title}")
+        elif item_type == "CHESS":
+            lines.append(f"- Chess: {action} {title}")
+        elif item_type == "HIGHLIGHT":
+            lines.append(f"- Highlighted: \"{title[:80]}\" — {summary}")
+        elif item_type == "POST":
+            lines.append(f"- Wrote a blog post: {title}")
+        elif item_type == "GAME":
+            lines.append(f"- {action}: {title}")
+        elif item_type == "PHOTO":
+            lines.append(f"- Shared a photo")
+        else:
+            lines.append(f"- {action}: {title}")
+
+    return "\n".join(lines)
+
+
+# A tag (quoted attribute values may contain '>') or a comment
+TAG_RE = re.compile(r"""<(/?)([a-zA-Z][\w-]*)(?:"[^"]*"|'[^']*'|[^'">])*>|<!--.*?-->""", re.S)
+
+# Each status is converted at most once per process
+STATUS_TEXT_CACHE_SIZE = 2048
+_status_text_cache = OrderedDict()  # (status ID, edited_at) -> text
+_status_text_lock = threading.Lock()
+
+
+def html_to_text(html):
+    """Single-pass HTML to text for Mastodon's sanitized status HTML.
+
+    <br> becomes a line break, paragraphs are separated by a blank line and
+    entities are decoded once at the end.
+    """
+    parts = []
+    pos = 0
+    for match in TAG_RE.finditer(html):
+        if match.start() > pos:
+            parts.append(html[pos:match.start()])
+        pos = match.end()
+        tag = (match.group(2) or '').lower()
+        if tag == 'br':
+            parts.append('\n')
+        elif tag == 'p' and not match.group(1) and parts:
+            parts.append('\n\n')
+    parts.append(html[pos:])
+    return unescape(''.join(parts))
+
+
+def status_text(status):
+    """Plain text of a status' HTML content, memoized by status ID."""
+    key = (str(status.id), getattr(status, 'edited_at', None))
+    text = _status_text_cache.get(key)
+    if text is None:
+        text = html_to_text(status.content)
+        with _status_text_lock:
+            _status_text_cache[key] = text
+            while len(_status_text_cache) > STATUS_TEXT_CACHE_SIZE:
+                _status_text_cache.popitem(last=False)
+    return text
+
+
+def fetch_concurrently(fetches, timeout=FETCH_TIMEOUT):
+    """Run independent fetches at the same time and wait for all of them.
+
+    `fetches` maps a name to a `(function, default)` pair. A fetch that raises
+    or runs past `timeout` seconds is logged and replaced by its default, the
+    same as the old one-at-a-time try/except blocks. One that ran out of time
+    is cancelled (see engine.py) and given CANCEL_GRACE seconds to stop, so
+    it isn't still writing to the store once the run has moved on.
+    """
+    results = {}
+    if not fetches:
+        return results
+
+    pool = ThreadPoolExecutor(max_workers=len(fetches))
+    # Each in a copy of this context, so they fetch for the caller's persona
+    started = {name: engine.submit(pool, metrics.timed(f'fetch.{name}')(fn))
+               for name, (fn, _) in fetches.items()}
+    deadline = time.monotonic() + timeout
+    given_up = {}
+    for name, (future, cancel) in started.items():
+        try:
+            results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception as e:
+            print(f'Error fetching {name}: {e!r}')
+            results[name] = fetches[name][1]
+            if not future.done():
+                cancel.set()
+                given_up[f'fetching {name}'] = future
+    engine.settle(given_up)
+    pool.shutdown(wait=False, cancel_futures=True)
+    return results
 
 
 def filter_out(string, substr):
@@ -151,42 +203,165 @@ def filter_out(string, substr):
             not any(sub in s for sub in substr) and not s.startswith("@")]
 
 
-def get_posts(mastodon, max_id=None):
-    source_posts = []
-    source_replies = []
-
-    statuses = mastodon.account_statuses(
-        id=SOURCE_ID,
-        limit=200,
-        max_id=max_id
+def store_source_statuses(store, statuses):
+    store.add_source_statuses(
+        (status.id, status.in_reply_to_id is not None, status_text(status), status.created_at)
+        for status in statuses
+        if len(status.content) != 0
     )
 
-    max_id = int(statuses[len(statuses) - 1].id) - 1
 
-    for status in statuses:
-        if len(status.content) != 0:
-            f = HTMLFilter()
-            f.feed(status.content)
+def sync_source_corpus(mastodon, store):
+    """Bring the local copy of the source account's statuses up to date.
 
-            if status.in_reply_to_id is None:
-                source_posts.append(f.text)
-            else:
-                source_replies.append(f.text)
+    New statuses are paged forward from the newest stored ID with min_id, so
+    a steady-state run transfers only what was posted since the last one.
+    Older history is backfilled SOURCE_BACKFILL_PAGES pages per run with
+    max_id until the start of the timeline is reached.
+    """
+    source_id = persona.current().source_id
+    oldest, newest = store.source_id_range()
 
-    return source_posts, source_replies, max_id
+    if newest is None:
+        page = mastodon.account_statuses(id=source_id, limit=SOURCE_PAGE_SIZE, max_id=None)
+        store_source_statuses(store, page)
+        fetched = len(page)
+    else:
+        fetched = 0
+        for _ in range(SOURCE_SYNC_PAGES):
+            page = mastodon.account_statuses(id=source_id, limit=SOURCE_PAGE_SIZE, min_id=newest)
+            store_source_statuses(store, page)
+            fetched += len(page)
+            if len(page) < SOURCE_PAGE_SIZE:
+                break
+            newest = max(int(status.id) for status in page)
+
+    for _ in range(SOURCE_BACKFILL_PAGES):
+        if store.get_meta('source_backfill_done'):
+            break
+        oldest, _ = store.source_id_range()
+        if oldest is None:
+            break
+        max_id = oldest - 1
+        page = mastodon.account_statuses(id=source_id, limit=SOURCE_PAGE_SIZE, max_id=max_id)
+        if not page:
+            store.set_meta('source_backfill_done', '1')
+            break
+        store_source_statuses(store, page)
+        fetched += len(page)
+
+    return fetched
+
+
+def get_posts(mastodon, store, limit=200):
+    """Posts and replies from the newest `limit` statuses of the synced corpus."""
+    fetched = sync_source_corpus(mastodon, store)
+    print(f'Synced {fetched} new statuses from {persona.current().source_handle}.')
+    return store.source_texts(limit)
+
+
+# Statuses in the bot's conversations (ancestors, the mentions themselves and
+# the bot's replies) already converted to text, keyed by status ID. Lives as
+# long as the process, so a warm Lambda remembers conversations between runs.
+THREAD_CACHE_SIZE = 512
+_thread_cache = OrderedDict()  # status ID -> (text, in_reply_to_id)
+_thread_cache_lock = threading.Lock()
+
+
+def _thread_text(status):
+    return re.sub(r'(@)\S+', '', status_text(status)).strip()
+
+
+def remember_thread(statuses):
+    """Cache `statuses` as thread ancestors for later mentions that reply to them."""
+    with _thread_cache_lock:
+        for status in statuses:
+            _thread_cache[str(status.id)] = (_thread_text(status), status.in_reply_to_id)
+            _thread_cache.move_to_end(str(status.id))
+        while len(_thread_cache) > THREAD_CACHE_SIZE:
+            _thread_cache.popitem(last=False)
+
+
+def build_thread(mastodon, status):
+    """Return the text of `status` and its ancestors, oldest first.
+
+    Ancestors come from a single status_context call instead of one request
+    per parent, and are cached, along with `status` itself, so later
+    mentions in the same conversation don't fetch them again.
+    """
+    ancestors = []
+    parent_id = status.in_reply_to_id
+    with _thread_cache_lock:
+        while parent_id is not None and str(parent_id) in _thread_cache:
+            _thread_cache.move_to_end(str(parent_id))
+            text, parent_id = _thread_cache[str(parent_id)]
+            ancestors.insert(0, text)
+
+    if parent_id is not None:
+        # Cache miss somewhere up the thread; fetch every ancestor at once
+        context = mastodon.status_context(id=status.id)
+        ancestors = [_thread_text(ancestor) for ancestor in context.ancestors]
+        remember_thread(context.ancestors)
+
+    remember_thread([status])
+    return ancestors + [_thread_text(status)]
+
+
+MENTION_PAGE_SIZE = 40  # Mastodon's maximum notifications per page
+
+
+def get_new_mentions(mastodon, store, max_pages=5):
+    """Mentions that arrived since the last one handled, oldest first.
+
+    The cursor is the ID of the last mention notification handled, kept in
+    the store as `mentions_min_id`. Without one (first run, or state lost)
+    only the newest mention is picked up, like before, rather than replying
+    to the whole history.
+    """
+    cursor = store.get_meta('mentions_min_id')
+    if cursor is None:
+        return list(mastodon.notifications(types=["mention"], limit=1))
+
+    mentions = []
+    for _ in range(max_pages):
+        page = mastodon.notifications(types=["mention"], min_id=cursor, limit=MENTION_PAGE_SIZE)
+        mentions.extend(page)
+        if len(page) < MENTION_PAGE_SIZE:
+            break
+        cursor = max((n.id for n in page), key=int)
+    return sorted(mentions, key=lambda n: int(n.id))
+
+
+def generate_mention_reply(mastodon, mention, bot_memory, now_et):
+    thread_parts = build_thread(mastodon, mention.status)
+
+    reply_system = system_with_voice(
+        "You are replying to someone. Keep it short, casual, lowercase. "
+        "Often just a few words. Think 'heck yeah' or 'oh nice' or a quick genuine reaction.",
+        bot_memory=bot_memory,
+        context="\n".join(thread_parts),
+    )
+
+    thread_display = "\n".join([f"> {part}" for part in thread_parts])
+    time_context = now_et.strftime("%A, %B %d, %Y at %I:%M %p ET")
+    reply_prompt = (
+        f"Current date and time: {time_context}\n\n"
+        f"Thread:\n{thread_display}\n\n"
+        f"Write a short reply in {persona.current().source_name}'s voice. Just the reply text, nothing else."
+    )
+
+    return generate(reply_system, reply_prompt, max_tokens=80, max_length=240)
 
 
 def get_bot_recent_posts(mastodon, limit=15):
-    """Fetch robot_mk's own recent posts for conversational memory."""
+    """Fetch the bot's own recent posts for conversational memory."""
     try:
-        statuses = mastodon.account_statuses(id=BOT_ID, limit=limit, exclude_replies=True)
+        statuses = mastodon.account_statuses(id=persona.current().bot_id, limit=limit, exclude_replies=True)
         posts = []
         for s in statuses:
             if s.reblog:
                 continue
-            f = HTMLFilter()
-            f.feed(s.content)
-            text = f.text.strip()
+            text = status_text(s).strip()
             if text:
                 posts.append(text)
         return posts
@@ -195,13 +370,93 @@ def get_bot_recent_posts(mastodon, limit=15):
         return []
 
 
-def system_with_voice(extra="", num_samples=25, bot_memory=None):
-    """Build a system prompt with random voice samples and conversational memory."""
+def get_voice_index():
+    """The TF-IDF index over the current persona's voice samples (see voice_index.py), or None."""
+    path = persona.current().voice_index
+    with _voice_lock:
+        if path not in _voice_indexes:
+            _voice_indexes[path] = voice_index.load(path)
+        return _voice_indexes[path]
+
+
+def relevant_samples(context, voice_samples):
+    """Indices of the voice samples most like `context`, if the index is usable."""
+    index = get_voice_index()
+    if index is None or index.count != len(voice_samples):
+        return []
+    return index.top_k(context, VOICE_RELEVANT_SAMPLES)
+
+
+def get_duplicate_index():
+    """The current persona's near-duplicate index over its voice samples and own posts (see dedupe.py).
+
+    Loaded from its DEDUPE_PATH when a previous run on this container left
+    one behind, otherwise from the voice samples' index built at package time
+    (see persona.build), and only built here if neither is there. Posts
+    passed to remember_posts are added.
+    """
+    me = persona.current()
+    with _duplicate_lock:
+        index = _duplicate_indexes.get(me.name)
+        if index is None:
+            index = dedupe.load(me.path(DEDUPE_PATH)) or dedupe.load(me.voice_dedupe)
+            if index is None:
+                index = dedupe.NearDuplicateIndex()
+                voice_samples = get_voice_samples()
+                for i in range(len(voice_samples)):
+                    index.add(('voice', i), voice_samples[i])
+            _duplicate_indexes[me.name] = index
+        unindexed = _unindexed_posts.get(me.name, [])
+        while unindexed:
+            index.add_recent(unindexed.pop(0))
+        return index
+
+
+def remember_posts(texts):
+    """Queue our own posts (oldest first) for the near-duplicate index."""
+    with _duplicate_lock:
+        _unindexed_posts.setdefault(persona.current().name, []).extend(texts)
+
+
+def save_duplicate_index():
+    me = persona.current()
+    index = _duplicate_indexes.get(me.name)
+    if index is not None and index.dirty:
+        try:
+            index.save(me.path(DEDUPE_PATH))
+        except Exception as e:
+            print(f'Error saving duplicate index: {e}')
+
+
+def system_with_voice(extra="", num_samples=25, bot_memory=None, context=None):
+    """Build system prompt blocks with random voice samples and conversational memory.
+
+    The persona's system prompt never changes, so it goes first as its own
+    block marked for prompt caching. The random samples, memory and extra
+    instructions follow in a second block. (The API skips caching for
+    prefixes shorter than the model's minimum cacheable length.)
+
+    With `context` (whatever is being replied to or referenced), the samples
+    are the VOICE_RELEVANT_SAMPLES most similar archive posts plus
+    VOICE_RANDOM_SAMPLES random ones instead of `num_samples` random ones.
+    """
+    me = persona.current()
     voice = ""
-    if VOICE_SAMPLES:
-        samples = random.sample(VOICE_SAMPLES, min(num_samples, len(VOICE_SAMPLES)))
+    voice_samples = get_voice_samples()
+    if voice_samples:
+        picks = relevant_samples(context, voice_samples) if context else []
+        if picks:
+            num_samples = len(picks) + VOICE_RANDOM_SAMPLES
+        chosen = set(picks)
+        for i in random.sample(range(len(voice_samples)), min(num_samples, len(voice_samples))):
+            if len(picks) >= num_samples:
+                break
+            if i not in chosen:
+                picks.append(i)
+                chosen.add(i)
+        samples = [voice_samples[i] for i in picks]
         voice = (
-            "\n\nREAL POSTS by Michael from his archive — this is his actual voice:\n"
+            f"\n\nREAL POSTS by {me.source_name} from the archive — this is {me.source_name}'s actual voice:\n"
             + "\n".join([f"- {s}" for s in samples])
         )
 
@@ -215,12 +470,93 @@ def system_with_voice(extra="", num_samples=25, bot_memory=None):
             + "\n".join([f"- {p}" for p in bot_memory])
         )
 
-    return SYSTEM_PROMPT + voice + memory + ("\n\n" + extra if extra else "")
-
-
-def generate(system, prompt, max_tokens=100):
-    response = client.messages.create(
-        model="claude-haiku-4-5-20251001",
+    blocks = [{"type": "text", "text": me.system_prompt, "cache_control": {"type": "ephemeral"}}]
+    dynamic = (voice + memory + ("\n\n" + extra if extra else "")).lstrip("\n")
+    if dynamic:
+        blocks.append({"type": "text", "text": dynamic})
+    return blocks
+
+
+# Things the voice rules forbid that can be checked without another model call
+STYLE_VIOLATIONS = [re.compile(r'#\w'), re.compile(r'https?://'), re.compile('—')]
+
+
+def strip_quotes(text):
+    if text.startswith('"') and text.endswith('"'):
+        return text[1:-1]
+    return text
+
+
+def candidate_score(text, max_length, check_duplicates=True):
+    """Rank a candidate post. None means it can't be posted at all."""
+    if not text or len(text) >= max_length:
+        return None
+    similarity = 0.0
+    if check_duplicates and len(text) >= DUPLICATE_MIN_LENGTH:
+        # Features running alongside may be adding their posts to it
+        with _duplicate_lock:
+            similarity = get_duplicate_index().similarity(text, DUPLICATE_THRESHOLD)
+        if similarity >= DUPLICATE_THRESHOLD:
+            print(f'Near-duplicate ({similarity:.2f}): {text}')
+            return None
+    violations = sum(1 for pattern in STYLE_VIOLATIONS if pattern.search(text))
+    return (-violations, -similarity, -len(text))
+
+
+@metrics.timed('generate')
+def generate(system, prompt, max_tokens=100, max_length=480, candidates=GENERATION_CANDIDATES,
+             check_duplicates=True):
+    """Generate a post from up to `candidates` requests, keeping the best.
+
+    With GENERATION_PICK = 'first' one request is sent, and the rest go out
+    together only if its candidate fails the length and near-duplicate
+    checks; the first that passes wins. With 'best' all candidates are sent
+    at once and ranked by candidate_score. If none pass, an over-long
+    candidate is returned so the caller can log why it was dropped, or '' if
+    they were all near-duplicates of something we (or the source account)
+    already posted.
+    """
+    rounds = [1, candidates - 1] if GENERATION_PICK == 'first' else [candidates]
+    pool = ThreadPoolExecutor(max_workers=max(candidates, 1))
+    results = []
+    error = None
+    try:
+        for count in rounds:
+            if count < 1 or any(score is not None for score, _ in results):
+                break
+            # Each in a copy of this context, so they count toward the caller's feature
+            futures = [pool.submit(contextvars.copy_context().run, complete, system, prompt, max_tokens)
+                       for _ in range(count)]
+            for future in as_completed(futures):
+                try:
+                    text = strip_quotes(future.result())
+                except Exception as e:
+                    print(f'Candidate failed: {e!r}')
+                    error = e
+                    continue
+                score = candidate_score(text, max_length, check_duplicates)
+                results.append((score, text))
+                if score is not None and GENERATION_PICK == 'first':
+                    break
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    valid = [result for result in results if result[0] is not None]
+    print(f'{len(valid)}/{len(results)} candidates usable')
+    if valid:
+        return max(valid)[1]
+    if not results:
+        raise error
+    too_long = [text for _, text in results if len(text) >= max_length]
+    return too_long[0] if too_long else ''
+
+
+@metrics.timed('anthropic.messages')
+def complete(system, prompt, max_tokens=100):
+    if engine.cancelled():
+        raise TimeoutError('feature ran out of time')
+    response = get_client().messages.create(
+        model=MODEL,
         max_tokens=max_tokens,
         system=system,
         messages=[
@@ -228,633 +564,865 @@ def generate(system, prompt, max_tokens=100):
         ],
         temperature=0.9,
     )
+    usage = response.usage
+    metrics.usage(usage)
+    print(
+        f'Tokens: {usage.input_tokens} in, {usage.output_tokens} out, '
+        f'{usage.cache_read_input_tokens or 0} cache read, '
+        f'{usage.cache_creation_input_tokens or 0} cache write'
+    )
     return response.content[0].text.strip()
 
 
-def main():
-    mastodon = Mastodon(
-        api_base_url='https://mastodon.social',
-        client_id=os.environ.get('MASTODON_CLIENT_KEY'),
-        client_secret=os.environ.get('MASTODON_CLIENT_SECRET'),
-        access_token=os.environ.get('MASTODON_ACCESS_TOKEN'),
-    )
+def post_prompt(source_posts, activity_context, time_context, is_april_fools=False):
+    """(prompt, context to pick voice samples by, whether the feed is in it) for a new post.
+
+    Used both live and by the post queue refill, so both write the same kind
+    of post. Whether the activity feed makes it in is chosen here at random.
+    """
+    name = persona.current().source_name
+    # Recent Mastodon posts (for recency context, not voice)
+    filtered = filter_out(source_posts, ["RT", "https://", "@"])
+    random.shuffle(filtered)
+    recent_section = "\n".join([f"- {post}" for post in filtered[:10]])
+
+    activity_section = ""
+    if activity_context and (random.choice(range(4)) == 0 or is_april_fools):
+        activity_section = (
+            f"{name} has been up to this stuff lately (background only):\n\n"
+            f"{activity_context}\n\n"
+            "You MAY reference one of these things in passing, but keep it subtle. "
+            "A passing thought, not a review.\n\n"
+        )
 
-    now_et = datetime.now(ET)
-    current_hour = now_et.hour
+    if is_april_fools:
+        prompt = (
+            f"Current date and time: {time_context}\n\n"
+            f"{activity_section}"
+            f"Here are some of {name}'s recent Mastodon posts for context:\n\n"
+            f"{recent_section}\n\n"
+            "It's April Fools' Day. Write a post that is a prank — something deadpan "
+            "and believable that sounds like a real announcement or life update, but is "
+            "actually absurd or fake. It should fool people for a few seconds before they "
+            f"realize it's a joke. Stay in {name}'s voice — lowercase, terse, dry. "
+            f"Reference {name}'s real projects, interests, or recent activity to make it convincing. "
+            "Do NOT say 'april fools' or hint that it's a joke. Let people figure it out.\n\n"
+            "Just the post text, nothing else. No quotes around it."
+        )
+    else:
+        prompt = (
+            f"Current date and time: {time_context}\n\n"
+            f"{activity_section}"
+            f"Here are some of {name}'s recent Mastodon posts for context on what {name}'s been talking about lately:\n\n"
+            f"{recent_section}\n\n"
+            "Write one new post in this exact voice. Match the tone, length, and style of "
+            "the archive posts in the system prompt. Be aware of the current date/time and "
+            "recent activity but don't force it. Many posts have nothing to do with current events.\n\n"
+            "Just the post text, nothing else. No quotes around it."
+        )
 
-    is_april_fools = now_et.month == 4 and now_et.day == 1
+    return prompt, activity_section + recent_section, bool(activity_section)
 
-    if not DEBUG:
-        guess = random.choice(range(ODDS))
-        reply_guess = random.choice(range(REPLY_ODDS))
-    else:
-        guess = 0
-        reply_guess = 0
 
-    # Sleep between 11pm and 8am Eastern
-    if DEBUG:
-        awake = True
-    else:
-        awake = 8 <= current_hour < 23
-    if awake:
-        print(f"I'm awake. {now_et.strftime('%I:%M %p ET')}")
-    else:
-        print(f"I'm asleep. {now_et.strftime('%I:%M %p ET')}")
+def open_store():
+    """The current persona's StateStore."""
+    me = persona.current()
+    return StateStore(me.path(STATE_PATH), s3_key=me.path(STATE_S3_KEY))
+
 
-    source_posts = []
-    source_replies = []
-    bot_memory = []
+def open_queue():
+    """The current persona's PostQueue."""
+    me = persona.current()
+    return PostQueue(me.path(POST_QUEUE_PATH), s3_key=me.path(POST_QUEUE_S3_KEY))
 
-    if awake:
-        print('Fetching my own recent posts for memory...')
+
+def take_queued_post(now_et, activity_context):
+    """The oldest fresh post from the queue (see post_queue.py), or None if there's none."""
+    try:
+        queue = open_queue()
+        activity = post_queue.activity_key(activity_context) if activity_context else None
+        dropped = queue.drop_stale(now_et.date().isoformat(), activity)
+        if dropped:
+            print(f'Dropped {dropped} stale queued posts.')
+        # Anything posted since it was queued may have made it a near-duplicate
+        text = queue.pop(lambda text: candidate_score(text, 480) is not None)
+        queue.save()
+        return text
+    except Exception as e:
+        print(f'Error reading the post queue: {e}')
+        return None
+
+
+def submit_batch(mastodon, queue, count, day, activity_context, bot_memory):
+    """Ask the Message Batches API for `count` posts' worth of candidates for `day`."""
+    # The corpus is synced first, since this container may never have run the
+    # hourly job, but not uploaded so the hourly run's copy isn't overwritten
+    store = open_store()
+    try:
+        source_posts, _ = get_posts(mastodon, store)
+    finally:
+        store.close(upload=False)
+    if not source_posts:
+        print('No source posts to write from; not submitting a batch.')
+        return
+    is_april_fools = day.month == 4 and day.day == 1
+    activity = post_queue.activity_key(activity_context) if activity_context else None
+
+    requests = []
+    meta = {}
+    for i in range(count * GENERATION_CANDIDATES):
+        prompt, context, uses_activity = post_prompt(
+            source_posts, activity_context, day.strftime("%A, %B %d, %Y"), is_april_fools)
+        custom_id = f'post-{i}'
+        requests.append({
+            'custom_id': custom_id,
+            'params': {
+                'model': MODEL,
+                'max_tokens': 120,
+                'system': system_with_voice(bot_memory=bot_memory, context=context),
+                'messages': [{'role': 'user', 'content': prompt}],
+                'temperature': 0.9,
+            },
+        })
+        meta[custom_id] = [day.isoformat(), activity if uses_activity else None]
+
+    batch = get_client().messages.batches.create(requests=requests)
+    queue.set_batch({'id': batch.id, 'requests': meta})
+    print(f'Submitted batch {batch.id} for {count} posts ({len(requests)} candidates).')
+
+
+def collect_batch(queue):
+    """Queue the usable posts from the batch in flight, if it has ended."""
+    client = get_client()
+    batch = client.messages.batches.retrieve(queue.batch['id'])
+    if batch.processing_status != 'ended':
+        print(f'Batch {batch.id} is still {batch.processing_status}.')
+        return
+
+    meta = queue.batch['requests']
+    # Candidates also mustn't repeat each other or what's already queued
+    queued = dedupe.NearDuplicateIndex()
+    for i, entry in enumerate(queue.entries):
+        queued.add(('queued', i), entry['text'])
+
+    results = []
+    for result in client.messages.batches.results(batch.id):
+        if result.result.type != 'succeeded':
+            print(f'Candidate {result.custom_id} {result.result.type}')
+            continue
+        message = result.result.message
+        metrics.usage(message.usage, metrics.BATCH_RATE)
+        text = strip_quotes(message.content[0].text.strip())
+        score = candidate_score(text, 480)
+        if score is not None:
+            results.append((score, text, meta[result.custom_id]))
+    if GENERATION_PICK == 'best':
+        results.sort(key=lambda result: result[0], reverse=True)
+
+    size = persona.current().setting('POST_QUEUE_SIZE')
+    added = 0
+    for score, text, (day, activity) in results:
+        if len(queue) >= size:
+            break
+        if len(text) >= DUPLICATE_MIN_LENGTH and queued.similarity(text, DUPLICATE_THRESHOLD) >= DUPLICATE_THRESHOLD:
+            continue
+        queued.add(('queued', len(queue)), text)
+        queue.add(text, day, activity)
+        added += 1
+    queue.set_batch(None)
+    print(f'Batch {batch.id} done: queued {added} of {len(results)} usable candidates.')
+
+
+def refill():
+    """Top up every persona's post queue off the hot path (see post_queue.py).
+
+    Collects the batch in flight once it has ended, then submits a new one
+    if the queue is still short. Posts are written for the bot's next
+    waking day: today, unless it's already past bedtime.
+    """
+    now_et = datetime.now(ET)
+    day = now_et.date() if now_et.hour < 23 else now_et.date() + timedelta(days=1)
+    each_persona(refill_persona, day)
+
+
+def refill_persona(day):
+    me = persona.current()
+    size = me.setting('POST_QUEUE_SIZE')
+    metrics.reset(me.name)
+    metrics.phase('refill')
+    queue = open_queue()
+    try:
+        # Candidates are checked against what the bot has posted lately
+        mastodon = connect_mastodon()
         bot_memory = get_bot_recent_posts(mastodon)
-        print(f'Memory: {len(bot_memory)} recent posts')
+        remember_posts(reversed(bot_memory))
+        if queue.batch:
+            collect_batch(queue)
+
+        activity_context = ''
+        if me.activity_url:
+            try:
+                activity_context = format_activity(activity_feed.fetch(me.activity_url, me.path(ACTIVITY_CACHE_PATH)))
+            except Exception as e:
+                print(f'Error fetching activity feed: {e}')
+        activity = post_queue.activity_key(activity_context) if activity_context else None
+        dropped = queue.drop_stale(day.isoformat(), activity)
+        print(f'Post queue: {len(queue)}/{size}, {dropped} stale dropped')
+        if not queue.batch and len(queue) < size:
+            submit_batch(mastodon, queue, size - len(queue), day, activity_context, bot_memory)
+    finally:
+        metrics.phase(None)
+        metrics.emit()
+        queue.save()
+        save_duplicate_index()
+
+
+def connect_mastodon():
+    """A Mastodon client with the current persona's credentials."""
+    from mastodon import Mastodon
+
+    me = persona.current()
+    cache_type_hints()
+    return Mastodon(
+        api_base_url=me.env('MASTODON_API_BASE_URL',
+                            os.environ.get('MASTODON_API_BASE_URL', 'https://mastodon.social')),
+        client_id=me.env('MASTODON_CLIENT_KEY'),
+        client_secret=me.env('MASTODON_CLIENT_SECRET'),
+        access_token=me.env('MASTODON_ACCESS_TOKEN'),
+        request_timeout=FETCH_TIMEOUT,
+        session=http_pool.session(),
+        # Don't sleep through a rate limit; RateLimitScheduler defers instead
+        ratelimit_method='throw',
+    )
 
-    # Daily post cap — count posts made today
-    posts_today = 0
-    if awake:
-        try:
-            today_start = now_et.replace(hour=0, minute=0, second=0, microsecond=0)
-            my_statuses = mastodon.account_statuses(id=BOT_ID, limit=20)
-            for s in my_statuses:
-                if s.created_at.replace(tzinfo=None) >= today_start.replace(tzinfo=None):
-                    posts_today += 1
-            print(f'Posts today: {posts_today}/{MAX_POSTS_PER_DAY}')
-            if posts_today >= MAX_POSTS_PER_DAY:
-                print('Hit daily post cap. Skipping all posting.')
-                return
-        except Exception as e:
-            print(f'Error checking daily cap: {e}')
 
-    # Guarantee at least one post on April Fools
-    if is_april_fools and posts_today == 0 and awake:
-        guess = 0
+def each_persona(fn, *args):
+    """Call `fn(*args)` for every persona at once, each with itself as persona.current().
 
-    if (guess == 0 or reply_guess == 0) and awake:
-        print('Fetching posts...')
-        max_id = None
+    They share the HTTP pools, the Anthropic client and the voice samples.
+    One that raises is logged and doesn't stop the others.
+    """
+    personas = persona.load()
 
-        source_posts_iter, source_replies_iter, max_id = get_posts(
-            mastodon, max_id)
-        source_posts += source_posts_iter
-        source_replies += source_replies_iter
-        print(f'{len(source_posts)} posts and {len(source_replies)} replies found in @mknepprath.')
+    def run_as(me):
+        persona.use(me)
+        fn(*args)
 
-        if len(source_posts) == 0:
-            print('Error fetching posts. Aborting.')
-            sys.exit()
+    with ThreadPoolExecutor(max_workers=min(len(personas), PERSONA_CONCURRENCY)) as pool:
+        futures = {me.name: pool.submit(contextvars.copy_context().run, run_as, me) for me in personas}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f'Error running {name}: {e!r}')
 
-    if guess == 0 and awake:
-        print('\nGenerating post...')
 
-        # Fetch activity feed for richer context
-        print('Fetching activity feed...')
-        activity_context = fetch_activity_feed()
-        if activity_context:
-            print(f'Got activity feed ({activity_context.count(chr(10)) + 1} items)')
+def roll(feature, odds):
+    """Roll the 1-in-`odds` chance that `feature` runs; 0 means it does.
 
-        # Recent Mastodon posts (for recency context, not voice)
-        filtered = filter_out(source_posts, ["RT", "https://", "@"])
-        random.shuffle(filtered)
-        recent_section = "\n".join([f"- {post}" for post in filtered[:10]])
+    Every feature's roll goes through here so benchmarks/endtoend.py can
+    force any combination of them.
+    """
+    return random.choice(range(odds))
 
-        time_context = now_et.strftime("%A, %B %d, %Y at %I:%M %p ET")
 
-        activity_section = ""
-        if activity_context and (random.choice(range(4)) == 0 or is_april_fools):
-            activity_section = (
-                f"Michael has been up to this stuff lately (background only):\n\n"
-                f"{activity_context}\n\n"
-                "You MAY reference one of these things in passing, but keep it subtle. "
-                "A passing thought, not a review.\n\n"
-            )
+def main(deadline=None):
+    """One hourly run of every persona. `deadline` is the time.monotonic() it has to be done by."""
+    cassette.begin()
+    now_et = cassette.clock(datetime.now(ET))
 
-        if is_april_fools:
-            prompt = (
-                f"Current date and time: {time_context}\n\n"
-                f"{activity_section}"
-                f"Here are some of his recent Mastodon posts for context:\n\n"
-                f"{recent_section}\n\n"
-                "It's April Fools' Day. Write a post that is a prank — something deadpan "
-                "and believable that sounds like a real announcement or life update, but is "
-                "actually absurd or fake. It should fool people for a few seconds before they "
-                "realize it's a joke. Stay in Michael's voice — lowercase, terse, dry. "
-                "Reference his real projects, interests, or recent activity to make it convincing. "
-                "Do NOT say 'april fools' or hint that it's a joke. Let people figure it out.\n\n"
-                "Just the post text, nothing else. No quotes around it."
-            )
-        else:
-            prompt = (
-                f"Current date and time: {time_context}\n\n"
-                f"{activity_section}"
-                f"Here are some of his recent Mastodon posts for context on what he's been talking about lately:\n\n"
-                f"{recent_section}\n\n"
-                "Write one new post in this exact voice. Match the tone, length, and style of "
-                "the archive posts in the system prompt. Be aware of the current date/time and "
-                "recent activity but don't force it. Many posts have nothing to do with current events.\n\n"
-                "Just the post text, nothing else. No quotes around it."
-            )
+    # Sleep between 11pm and 8am Eastern
+    awake = DEBUG or 8 <= now_et.hour < 23
+    if not awake:
+        print(f"I'm asleep. {now_et.strftime('%I:%M %p ET')}")
+        return
+    print(f"I'm awake. {now_et.strftime('%I:%M %p ET')}")
 
-        generated = generate(system_with_voice(bot_memory=bot_memory), prompt, max_tokens=120)
+    http_before = http_pool.stats()
+    cassette.seed_random()
+    try:
+        each_persona(run_persona, now_et, deadline)
+    finally:
+        print(http_pool.report(http_before))
+        cassette.save()
+
+
+def run_persona(now_et, deadline=None):
+    """The current persona's part of the run, with its own state and Mastodon budget."""
+    me = persona.current()
+    metrics.reset(me.name)
+    store = open_store()
+    cassette.snapshot([store.path, me.path(DEDUPE_PATH), me.path(ACTIVITY_CACHE_PATH), me.path(POST_QUEUE_PATH)])
+    # Where the last run left the rate limit window
+    saved = store.get_meta('mastodon_ratelimit')
+    remaining, reset = map(float, saved.split()) if saved else (None, None)
+
+    # Connects on the first request, so runs that do nothing never import Mastodon.py.
+    # Rebuilding state reads 50 of the bot's own statuses, the most any feature does.
+    api = RateLimitScheduler(CachedMastodon(connect_mastodon, limits={me.bot_id: 50}, own_id=me.bot_id),
+                             me.setting('MASTODON_BUDGETS'), remaining, reset)
+    try:
+        run(api, store, now_et, deadline)
+    except Deferred as e:
+        print(f'Out of Mastodon budget, stopping until the next run: {e}')
+    finally:
+        metrics.phase(None)
+        print(api.summary())
+        metrics.emit()
+        if api.reset is not None:
+            store.set_meta('mastodon_ratelimit', f'{api.remaining} {api.reset}')
+        store.close()
+        save_duplicate_index()
+
+
+def run(api, store, now_et, deadline=None):
+    me = persona.current()
+    max_posts = me.setting('MAX_POSTS_PER_DAY')
+    is_april_fools = now_et.month == 4 and now_et.day == 1
 
-        # Strip quotes if the model wraps the output
-        if generated.startswith('"') and generated.endswith('"'):
-            generated = generated[1:-1]
+    # Daily post cap — count posts made today
+    metrics.phase('cap_check')
+    mastodon = api.feature('core')
+    posts_today = 0
+    try:
+        if store.is_empty():
+            print('No saved state. Rebuilding from my timeline...')
+            store.rebuild_from_timeline(mastodon.account_statuses(id=me.bot_id, limit=50))
+        today_start = now_et.replace(hour=0, minute=0, second=0, microsecond=0)
+        posts_today = store.count_statuses_since(today_start)
+        print(f'Posts today: {posts_today}/{max_posts}')
+        if posts_today >= max_posts:
+            print('Hit daily post cap. Skipping all posting.')
+            return
+    except Exception as e:
+        print(f'Error checking daily cap: {e}')
 
-        print(f'Generated: {generated}')
+    # Every feature is rolled now, and what they need fetched follows from that
+    forced = {'post', 'reply'} if DEBUG else set()
+    # Guarantee at least one post on April Fools
+    if is_april_fools and posts_today == 0:
+        forced.add('post')
+    actions = planner.plan(roll, api, forced)
+    print(f'Plan: {", ".join(actions) or "nothing"}')
+    if not actions:
+        return
+    sibling_id = random.choice(list(me.siblings)) if 'commentary' in actions else None
+
+    # Each fetch is charged to the budget of the first action that needs it
+    needed = planner.needs(actions)
+    fetchers = {
+        'memory': (lambda: get_bot_recent_posts(api.feature(needed['memory'])), []),
+        'posts': (lambda: get_posts(api.feature(needed['posts']), store), ([], [])),
+        'activity': (lambda: activity_feed.fetch(me.activity_url, me.path(ACTIVITY_CACHE_PATH))
+                     if me.activity_url else [], []),
+        'mentions': (lambda: get_new_mentions(api.feature(needed['mentions']), store), []),
+        'follows': (lambda: follows.sync(api.feature(needed['follows']), store), None),
+        # These only warm the run's timeline cache for the features that read them
+        'source_timeline': (lambda: api.feature(needed['source_timeline']).account_statuses(
+            id=me.source_id, limit=5, exclude_replies=True), []),
+        'sibling_timeline': (lambda: api.feature(needed['sibling_timeline']).account_statuses(
+            id=sibling_id, limit=5, exclude_replies=True), []),
+        'lilt_timeline': (lambda: api.feature(needed['lilt_timeline']).account_statuses(
+            id=me.lilt['id'], limit=20), []),
+    }
+    fetches = {need: fetchers[need] for need in needed}
 
-        if generated is not None and len(generated) < 480:
-            if not DEBUG:
-                if generated != '':
-                    mastodon.status_post(status=generated)
-                    print(f'Posted: {generated}')
-                else:
-                    print('No status to post.')
-            else:
-                print(f'Didn\'t post \'{generated}\' because DEBUG is True.')
+    metrics.phase('fetch')
+    print(f'Fetching {", ".join(fetches)}...')
+    fetched = fetch_concurrently(fetches)
+
+    bot_memory = fetched.get('memory', [])
+    print(f'Memory: {len(bot_memory)} recent posts')
+    remember_posts(reversed(bot_memory))
 
-        elif generated is None:
-            print('Post is empty, sorry.')
+    source_posts, source_replies = fetched.get('posts', ([], []))
+    if 'posts' in fetched:
+        print(f'{len(source_posts)} posts and {len(source_replies)} replies found in {me.source_handle}.')
+
+        if len(source_posts) == 0:
+            print('Error fetching posts. Aborting.')
+            return
+
+    features = {
+        'post': lambda: run_post(api, store, now_et, bot_memory, source_posts, fetched['activity'],
+                                 is_april_fools),
+        'reply': lambda: run_mentions(api, store, now_et, bot_memory, fetched['mentions'], posts_today),
+        'boost': lambda: run_boost(api, store),
+        'commentary': lambda: run_commentary(api, store, bot_memory, sibling_id),
+        'source_reply': lambda: run_source_reply(api, store, bot_memory),
+        'follow': lambda: run_follows(api, store, fetched['follows']),
+        'follower_reply': lambda: run_follower_reply(api, store, bot_memory),
+        'review': lambda: run_review(api, store, bot_memory),
+        'count': lambda: run_count(api, store, now_et, bot_memory, fetched['activity']),
+        'lilt': lambda: run_lilt(api, store, bot_memory),
+    }
+    # Every planned feature at once, each starting its own phase
+    metrics.phase(None)
+    engine.run({action: features[action] for action in actions},
+               deadline=None if deadline is None else deadline - DEADLINE_MARGIN)
+
+
+def run_post(api, store, now_et, bot_memory, source_posts, activity, is_april_fools):
+    """Generate and post a new status."""
+    print('\nGenerating post...')
+    metrics.phase('post')
+    mastodon = api.feature('post')
+
+    # Activity feed for richer context
+    activity_context = format_activity(activity)
+    if activity_context:
+        print(f'Got activity feed ({activity_context.count(chr(10)) + 1} items)')
+
+    generated = None if DEBUG else take_queued_post(now_et, activity_context)
+    if generated is not None:
+        print(f'From the queue: {generated}')
+    else:
+        time_context = now_et.strftime("%A, %B %d, %Y at %I:%M %p ET")
+        prompt, context, _ = post_prompt(source_posts, activity_context, time_context, is_april_fools)
+        post_system = system_with_voice(bot_memory=bot_memory, context=context)
+        generated = generate(post_system, prompt, max_tokens=120)
+
+    print(f'Generated: {generated}')
+
+    if generated is not None and len(generated) < 480:
+        if not DEBUG:
+            if generated != '':
+                posted = mastodon.status_post(status=generated)
+                store.record('post', status=posted)
+                remember_posts([generated])
+                print(f'Posted: {generated}')
+            else:
+                print('No status to post.')
         else:
-            print(f'BAD POST (too long): {generated}')
+            print(f'Didn\'t post \'{generated}\' because DEBUG is True.')
 
+    elif generated is None:
+        print('Post is empty, sorry.')
     else:
-        if DEBUG:
-            print(f'{guess} No, sorry, not this time.')
-
-    if reply_guess == 0 and awake:
-        source_mentions = mastodon.notifications(types=["mention"], limit=1)
-
-        print('\nGetting last mention.')
-
-        for mention in source_mentions:
-            f = HTMLFilter()
-            f.feed(mention.status.content)
-
-            mention_text = re.sub(r'(@)\S+', '', f.text).strip()
-
-            # Only do this while awake, sometimes.
-            if random.choice(range(FAVE_ODDS)) == 0 and awake:
-                if not mention.status.favourited:
-                    mastodon.status_favourite(id=mention.status.id)
-                    print(f'\nFavorited: {mention.status.content}')
-
-            # Build thread context
-            thread_parts = [mention_text]
-            if mention.status.in_reply_to_id is not None:
-                parent = mention.status
-                while parent.in_reply_to_id is not None:
-                    parent = mastodon.status(id=parent.in_reply_to_id)
-                    f = HTMLFilter()
-                    f.feed(parent.content)
-                    parent_text = re.sub(r'(@)\S+', '', f.text).strip()
-                    thread_parts.insert(0, parent_text)
-
-            # Check if we already replied
-            replied = False
-            bot_statuses = mastodon.account_statuses(id=BOT_ID, limit=50)
-            for s in bot_statuses:
-                if s.in_reply_to_id == mention.status.id:
-                    replied = True
-                    print('Already replied to this mention.')
-                    break
+        print(f'BAD POST (too long): {generated}')
+
+
+def run_mentions(api, store, now_et, bot_memory, source_mentions, posts_today):
+    """Reply to new mentions."""
+    metrics.phase('mentions')
+    mastodon = api.feature('replies')
+    print(f'\n{len(source_mentions)} new mentions.')
+
+    # Every mention since the cursor gets a reply, up to MAX_MENTIONS_PER_RUN
+    # and whatever's left of the daily cap. The rest wait for the next run.
+    me = persona.current()
+    budget = min(me.setting('MAX_MENTIONS_PER_RUN'), me.setting('MAX_POSTS_PER_DAY') - posts_today)
+    queue = []
+    handled = 0
+    for mention in source_mentions:
+        if store.has_replied_to(mention.status.id):
+            print(f'Already replied to mention {mention.status.id}.')
+        elif len(queue) < budget and store.claim(mention.status.id):
+            queue.append(mention)
+        else:
+            # Out of budget, or another feature is replying to it right now
+            break
+        handled += 1
+
+    # Only do this sometimes.
+    for mention in queue:
+        if roll('fave', me.setting('FAVE_ODDS')) == 0 and not mention.status.favourited:
+            mastodon.status_favourite(id=mention.status.id)
+            store.record('favourite', target_id=mention.status.id)
+            print(f'\nFavorited: {mention.status.content}')
+
+    if queue:
+        print(f'Generating {len(queue)} replies...\n')
+    if not DEBUG:
+        # A copy of this context for each, so they count toward this feature
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=len(queue) or 1) as pool:
+            replies = list(pool.map(
+                lambda mention: context.copy().run(
+                    generate_mention_reply, mastodon, mention, bot_memory, now_et),
+                queue))
+    else:
+        replies = ['test reply from debug mode'] * len(queue)
 
-            if awake and not replied:
-                print('Generating reply...\n')
+    for mention, generated_reply in zip(queue, replies):
+        print(f'Reply: {generated_reply}')
 
-                if not DEBUG:
-                    filtered = filter_out(source_posts, ["RT", "https://", "@"])
-                    random.shuffle(filtered)
-                    previous_posts = "\n".join([f"- {post}" for post in filtered[:20]])
+        if generated_reply and len(generated_reply) < 240:
+            if not DEBUG:
+                posted = mastodon.status_post(status=generated_reply, in_reply_to_id=mention.status.id)
+                store.record('reply', status=posted)
+                # The next mention in this conversation will be a reply to it
+                remember_thread([posted])
+                remember_posts([generated_reply])
+                print(f'Replied: {generated_reply}')
+            else:
+                print(f'Didn\'t reply \'{generated_reply}\' because DEBUG is True.')
 
-                    reply_system = system_with_voice(
-                        "You are replying to someone. Keep it short, casual, lowercase. "
-                        "Often just a few words. Think 'heck yeah' or 'oh nice' or a quick genuine reaction.",
-                        bot_memory=bot_memory,
-                    )
+    # Advance past everything handled, including mentions already replied to
+    if handled and not DEBUG:
+        store.set_meta('mentions_min_id', str(source_mentions[handled - 1].id))
 
-                    thread_display = "\n".join([f"> {part}" for part in thread_parts])
-                    time_context = now_et.strftime("%A, %B %d, %Y at %I:%M %p ET")
-                    reply_prompt = (
-                        f"Current date and time: {time_context}\n\n"
-                        f"Thread:\n{thread_display}\n\n"
-                        "Write a short reply in Michael's voice. Just the reply text, nothing else."
-                    )
 
-                    generated_reply = generate(reply_system, reply_prompt, max_tokens=80)
+def run_boost(api, store):
+    """Occasionally boost a recent post by the source account."""
+    print('\nChecking for posts to boost...')
+    metrics.phase('boost')
+    mastodon = api.feature('boost')
+    try:
+        recent = mastodon.account_statuses(id=persona.current().source_id, limit=5, exclude_replies=True)
+        for post in recent:
+            if not post.reblogged and not post.in_reply_to_id and not store.has_boosted(post.id):
+                boosted = mastodon.status_reblog(id=post.id)
+                store.record('boost', status=boosted, target_id=post.id)
+                print(f'Boosted: {status_text(post)[:80]}')
+                break
+        else:
+            print('No new posts to boost.')
+    except Exception as e:
+        print(f'Error boosting: {e}')
 
-                    # Strip quotes
-                    if generated_reply.startswith('"') and generated_reply.endswith('"'):
-                        generated_reply = generated_reply[1:-1]
-                else:
-                    generated_reply = 'test reply from debug mode'
 
-                print(f'Reply: {generated_reply}')
+def run_commentary(api, store, bot_memory, sibling_id):
+    """Occasionally share a post from one of the persona's sibling accounts with commentary."""
+    print('\nChecking sibling bots for commentary boost...')
+    metrics.phase('commentary')
+    mastodon = api.feature('boost')
+    try:
+        bot_info = persona.current().siblings[sibling_id]
+        recent = mastodon.account_statuses(id=sibling_id, limit=5, exclude_replies=True)
+
+        # Skip anything we've already commented on
+        for post in recent:
+            if post.url and not store.has_commented_on(post.url):
+                post_text = status_text(post).strip()
+
+                if not post_text:
+                    continue
+
+                commentary_system = system_with_voice(
+                    f"You are commenting on a post from {bot_info['handle']}. "
+                    f"{bot_info['context']} You made this bot — it's your project. "
+                    "React naturally, the way you'd react to your own bot doing its thing. "
+                    "Maybe you think the output is funny, or mid, or you have a take on the content. "
+                    "Be honest. Keep it short. The post URL will be appended automatically.",
+                    bot_memory=bot_memory,
+                    context=post_text,
+                )
+
+                commentary_prompt = (
+                    f"Here's the post from {bot_info['handle']}:\n\n"
+                    f"{post_text[:300]}\n\n"
+                    "Write a short comment. Just the text, nothing else."
+                )
 
-                if generated_reply and len(generated_reply) < 240:
+                commentary = generate(commentary_system, commentary_prompt, max_tokens=80,
+                                      max_length=480 - len(post.url) - 2)
+
+                status = f"{commentary}\n\n{post.url}"
+
+                if len(status) < 480:
                     if not DEBUG:
-                        mastodon.status_post(status=generated_reply, in_reply_to_id=mention.status.id)
-                        print(f'Replied: {generated_reply}')
+                        posted = mastodon.status_post(status=status)
+                        store.record('commentary', status=posted, url=post.url)
+                        remember_posts([commentary])
+                        print(f'Commentary on {bot_info["handle"]}: {commentary}')
                     else:
-                        print(f'Didn\'t reply \'{generated_reply}\' because DEBUG is True.')
-            else:
-                print('Not replying this time.')
-    else:
-        if DEBUG:
-            print(f'{reply_guess} No reply this time.')
+                        print(f'Would comment on {bot_info["handle"]}: {commentary}')
+                break
+        else:
+            print(f'No new posts from {bot_info["handle"]} to comment on.')
+    except Exception as e:
+        print(f'Error with sibling bot commentary: {e}')
 
-    # Occasionally boost a recent @mknepprath post
-    if awake and random.choice(range(BOOST_ODDS)) == 0:
-        print('\nChecking for posts to boost...')
-        try:
-            recent = mastodon.account_statuses(id=SOURCE_ID, limit=5, exclude_replies=True)
-            for post in recent:
-                if not post.reblogged and not post.in_reply_to_id:
-                    mastodon.status_reblog(id=post.id)
-                    f = HTMLFilter()
-                    f.feed(post.content)
-                    print(f'Boosted: {f.text[:80]}')
-                    break
-            else:
-                print('No new posts to boost.')
-        except Exception as e:
-            print(f'Error boosting: {e}')
-
-    # Occasionally share a post from one of Michael's bot accounts with commentary
-    SIBLING_BOTS = {
-        "109447224294183229": {
-            "handle": "@EveryPkmnCard",
-            "context": "Posts a new Pokemon card every hour. Michael built this bot.",
-        },
-        "109852410462840995": {
-            "handle": "@PokemonFacts",
-            "context": "Posts Pokemon facts. Another one of Michael's bots.",
-        },
-        "113479454947259743": {
-            "handle": "@boutbot",
-            "context": "Bot for Who Goes There?, a social deduction game Michael built.",
-        },
-        "113479368818279476": {
-            "handle": "@familiarlilt",
-            "context": "Bot for Lilt, a text adventure game Michael built.",
-        },
-        "113490843400044713": {
-            "handle": "@designprompts",
-            "context": "Posts design prompts and challenges. Another Michael creation.",
-        },
-    }
 
-    if awake and random.choice(range(BOOST_ODDS)) == 0:
-        print('\nChecking sibling bots for commentary boost...')
-        try:
-            bot_id = random.choice(list(SIBLING_BOTS.keys()))
-            bot_info = SIBLING_BOTS[bot_id]
-            recent = mastodon.account_statuses(id=bot_id, limit=5, exclude_replies=True)
-
-            # Check our recent posts to avoid commenting on the same thing twice
-            my_recent = mastodon.account_statuses(id=BOT_ID, limit=30)
-            recent_urls = set()
-            for s in my_recent:
-                f = HTMLFilter()
-                f.feed(s.content)
-                recent_urls.add(f.text)
-
-            for post in recent:
-                if post.url and not any(post.url in u for u in recent_urls):
-                    f = HTMLFilter()
-                    f.feed(post.content)
-                    post_text = f.text.strip()
-
-                    if not post_text:
-                        continue
+def run_source_reply(api, store, bot_memory):
+    """Occasionally reply to the source account's own posts."""
+    me = persona.current()
+    source = me.source_handle
+    print(f'\nChecking if I should reply to {source}...')
+    metrics.phase('source_reply')
+    mastodon = api.feature('replies')
+    try:
+        recent = mastodon.account_statuses(id=me.source_id, limit=5, exclude_replies=True)
+
+        for post in recent:
+            if not store.has_replied_to(post.id) and not post.in_reply_to_id and store.claim(post.id):
+                post_text = status_text(post).strip()
+                if not post_text:
+                    continue
+
+                reply_system = system_with_voice(
+                    f"You are replying to a post by the real {source} — the person you're "
+                    f"a doppelganger of. This is your chance to riff on what {me.source_name} said. "
+                    f"Be playful, deadpan, or just react. You're basically {me.source_name}'s echo with opinions. "
+                    "Keep it very short.",
+                    bot_memory=bot_memory,
+                    context=post_text,
+                )
 
-                    commentary_system = system_with_voice(
-                        f"You are commenting on a post from {bot_info['handle']}. "
-                        f"{bot_info['context']} You made this bot — it's your project. "
-                        "React naturally, the way you'd react to your own bot doing its thing. "
-                        "Maybe you think the output is funny, or mid, or you have a take on the content. "
-                        "Be honest. Keep it short. The post URL will be appended automatically.",
-                        bot_memory=bot_memory,
-                    )
+                reply_prompt = (
+                    f"Here's what {source} posted:\n\n"
+                    f"{post_text[:300]}\n\n"
+                    "Write a short reply. Just the text, nothing else."
+                )
 
-                    commentary_prompt = (
-                        f"Here's the post from {bot_info['handle']}:\n\n"
-                        f"{post_text[:300]}\n\n"
-                        "Write a short comment. Just the text, nothing else."
-                    )
+                reply = generate(reply_system, reply_prompt, max_tokens=80, max_length=240)
 
-                    commentary = generate(commentary_system, commentary_prompt, max_tokens=80)
+                if reply and len(reply) < 240:
+                    if not DEBUG:
+                        posted = mastodon.status_post(status=reply, in_reply_to_id=post.id)
+                        store.record('source_reply', status=posted)
+                        remember_posts([reply])
+                        print(f'Replied to {source}: {reply}')
+                    else:
+                        print(f'Would reply to {source}: {reply}')
+                break
+    except Exception as e:
+        print(f'Error replying to {source}: {e}')
 
-                    if commentary.startswith('"') and commentary.endswith('"'):
-                        commentary = commentary[1:-1]
 
-                    status = f"{commentary}\n\n{post.url}"
+def run_follows(api, store, pending):
+    """Follow back anyone who follows us, and unfollow anyone who unfollowed."""
+    print('\nManaging follows...')
+    metrics.phase('follows')
+    mastodon = api.feature('follows')
+    try:
+        if pending is None:
+            raise ValueError('follower lists unavailable')
+        follows.apply(mastodon, store, *pending)
+    except Exception as e:
+        print(f'Error managing follows: {e}')
 
-                    if len(status) < 480:
-                        if not DEBUG:
-                            mastodon.status_post(status=status)
-                            print(f'Commentary on {bot_info["handle"]}: {commentary}')
-                        else:
-                            print(f'Would comment on {bot_info["handle"]}: {commentary}')
-                    break
-            else:
-                print(f'No new posts from {bot_info["handle"]} to comment on.')
-        except Exception as e:
-            print(f'Error with sibling bot commentary: {e}')
 
-    # Occasionally reply to @mknepprath's own posts
-    if awake and random.choice(range(36)) == 0:
-        print('\nChecking if I should reply to @mknepprath...')
-        try:
-            recent = mastodon.account_statuses(id=SOURCE_ID, limit=5, exclude_replies=True)
-            bot_statuses = mastodon.account_statuses(id=BOT_ID, limit=50)
-            replied_to_ids = {s.in_reply_to_id for s in bot_statuses if s.in_reply_to_id}
-
-            for post in recent:
-                if post.id not in replied_to_ids and not post.in_reply_to_id:
-                    f = HTMLFilter()
-                    f.feed(post.content)
-                    post_text = f.text.strip()
-                    if not post_text:
+def run_follower_reply(api, store, bot_memory):
+    """Rarely reply to a follower's recent post (they followed us = consent)."""
+    print('\nChecking followers timeline for something to reply to...')
+    metrics.phase('follower_reply')
+    mastodon = api.feature('replies')
+    try:
+        # Skip the source account and other bots
+        me = persona.current()
+        real_follows = [(id, acct) for id, acct, bot in store.accounts('following')
+                        if id != me.source_id and id != me.bot_id and not bot]
+
+        if real_follows:
+            target_id, target_acct = random.choice(real_follows)
+            their_posts = mastodon.account_statuses(id=target_id, limit=5, exclude_replies=True)
+
+            for post in their_posts:
+                if not store.has_replied_to(post.id) and not post.in_reply_to_id and store.claim(post.id):
+                    post_text = status_text(post).strip()
+                    if not post_text or len(post_text) < 10:
                         continue
 
                     reply_system = system_with_voice(
-                        "You are replying to a post by the real @mknepprath — the person you're "
-                        "a doppelganger of. This is your chance to riff on what he said. "
-                        "Be playful, deadpan, or just react. You're basically his echo with opinions. "
-                        "Keep it very short.",
+                        f"You are replying to a post by @{target_acct}, someone who follows you. "
+                        "Be casual and friendly. Just a quick genuine reaction. Keep it very short.",
                         bot_memory=bot_memory,
+                        context=post_text,
                     )
 
                     reply_prompt = (
-                        f"Here's what @mknepprath posted:\n\n"
+                        f"Here's what @{target_acct} posted:\n\n"
                         f"{post_text[:300]}\n\n"
                         "Write a short reply. Just the text, nothing else."
                     )
 
-                    reply = generate(reply_system, reply_prompt, max_tokens=80)
-                    if reply.startswith('"') and reply.endswith('"'):
-                        reply = reply[1:-1]
+                    reply = generate(reply_system, reply_prompt, max_tokens=60, max_length=200)
 
-                    if reply and len(reply) < 240:
+                    if reply and len(reply) < 200:
                         if not DEBUG:
-                            mastodon.status_post(status=reply, in_reply_to_id=post.id)
-                            print(f'Replied to @mknepprath: {reply}')
+                            posted = mastodon.status_post(status=reply, in_reply_to_id=post.id)
+                            store.record('follower_reply', status=posted)
+                            remember_posts([reply])
+                            print(f'Replied to @{target_acct}: {reply}')
                         else:
-                            print(f'Would reply to @mknepprath: {reply}')
+                            print(f'Would reply to @{target_acct}: {reply}')
                     break
-        except Exception as e:
-            print(f'Error replying to @mknepprath: {e}')
-
-    # Follow-back management: follow anyone who follows us, unfollow anyone who unfollowed
-    if awake and random.choice(range(6)) == 0:
-        print('\nManaging follows...')
-        try:
-            followers = mastodon.account_followers(id=BOT_ID, limit=80)
-            following = mastodon.account_following(id=BOT_ID, limit=80)
-
-            follower_ids = {f.id for f in followers}
-            following_ids = {f.id for f in following}
-
-            # Follow back new followers
-            for follower in followers:
-                if follower.id not in following_ids and not follower.bot:
-                    mastodon.account_follow(id=follower.id)
-                    print(f'Followed back: @{follower.acct}')
-
-            # Unfollow anyone who unfollowed us (except the source account)
-            for account in following:
-                if account.id not in follower_ids and str(account.id) != SOURCE_ID:
-                    mastodon.account_unfollow(id=account.id)
-                    print(f'Unfollowed: @{account.acct}')
-        except Exception as e:
-            print(f'Error managing follows: {e}')
-
-    # Rarely reply to a follower's recent post (they followed us = consent)
-    if awake and random.choice(range(48)) == 0:
-        print('\nChecking followers timeline for something to reply to...')
-        try:
-            following = mastodon.account_following(id=BOT_ID, limit=80)
-            # Skip the source account and other bots
-            real_follows = [f for f in following if str(f.id) != SOURCE_ID
-                           and str(f.id) != BOT_ID and not f.bot]
-
-            if real_follows:
-                target = random.choice(real_follows)
-                their_posts = mastodon.account_statuses(id=target.id, limit=5, exclude_replies=True)
-
-                bot_statuses = mastodon.account_statuses(id=BOT_ID, limit=50)
-                replied_to_ids = {s.in_reply_to_id for s in bot_statuses if s.in_reply_to_id}
-
-                for post in their_posts:
-                    if post.id not in replied_to_ids and not post.in_reply_to_id:
-                        f = HTMLFilter()
-                        f.feed(post.content)
-                        post_text = f.text.strip()
-                        if not post_text or len(post_text) < 10:
-                            continue
-
-                        reply_system = system_with_voice(
-                            f"You are replying to a post by @{target.acct}, someone who follows you. "
-                            "Be casual and friendly. Just a quick genuine reaction. Keep it very short.",
-                            bot_memory=bot_memory,
-                        )
-
-                        reply_prompt = (
-                            f"Here's what @{target.acct} posted:\n\n"
-                            f"{post_text[:300]}\n\n"
-                            "Write a short reply. Just the text, nothing else."
-                        )
-
-                        reply = generate(reply_system, reply_prompt, max_tokens=60)
-                        if reply.startswith('"') and reply.endswith('"'):
-                            reply = reply[1:-1]
-
-                        if reply and len(reply) < 200:
-                            if not DEBUG:
-                                mastodon.status_post(status=reply, in_reply_to_id=post.id)
-                                print(f'Replied to @{target.acct}: {reply}')
-                            else:
-                                print(f'Would reply to @{target.acct}: {reply}')
-                        break
-        except Exception as e:
-            print(f'Error replying to follower: {e}')
-
-    # Rarely review own post history
-    if awake and random.choice(range(72)) == 0:
-        print('\nReviewing my own post history...')
-        try:
-            my_posts = mastodon.account_statuses(id=BOT_ID, limit=20, exclude_replies=True)
-            # Pick a post from a few days ago
-            older_posts = [p for p in my_posts[5:] if not p.reblog]
-
-            if older_posts:
-                target_post = random.choice(older_posts)
-                f = HTMLFilter()
-                f.feed(target_post.content)
-                old_text = f.text.strip()
-
-                if old_text:
-                    review_system = system_with_voice(
-                        "You are looking back at one of your own previous posts and reacting to it. "
-                        "Be honest — was it good? cringe? funny? did it age well? "
-                        "This is a self-review. Be terse and real. Keep it very short.",
-                        bot_memory=bot_memory,
-                    )
-
-                    review_prompt = (
-                        f"Here's one of your old posts:\n\n"
-                        f"{old_text[:300]}\n\n"
-                        "Write a brief self-review as a reply. Just the text, nothing else."
-                    )
-
-                    review = generate(review_system, review_prompt, max_tokens=60)
-                    if review.startswith('"') and review.endswith('"'):
-                        review = review[1:-1]
+    except Exception as e:
+        print(f'Error replying to follower: {e}')
 
-                    if review and len(review) < 240:
-                        if not DEBUG:
-                            mastodon.status_post(status=review, in_reply_to_id=target_post.id)
-                            print(f'Self-review of "{old_text[:40]}": {review}')
-                        else:
-                            print(f'Would self-review "{old_text[:40]}": {review}')
-        except Exception as e:
-            print(f'Error reviewing post history: {e}')
 
-    # The count — track an arbitrary thing with no context
-    if awake and random.choice(range(48)) == 0:
-        print('\nChecking the count...')
-        try:
-            activity_context = fetch_activity_feed()
-            if activity_context:
-                count_system = system_with_voice(
-                    "You have an obsessive habit of counting arbitrary things based on "
-                    "Michael's recent activity. Pick something oddly specific to count and "
-                    "post the count with zero context. Examples of the format:\n"
-                    "- days since last hitchcock movie: 4\n"
-                    "- consecutive runs under 6 miles: 3\n"
-                    "- films watched this month: 7\n"
-                    "- pokemon cards posted since last shiny: 12\n\n"
-                    "Pick something real from the activity feed. Be specific and a little weird. "
-                    "Just the count line, nothing else. lowercase, no punctuation at the end.",
+def run_review(api, store, bot_memory):
+    """Rarely review own post history."""
+    print('\nReviewing my own post history...')
+    metrics.phase('review')
+    mastodon = api.feature('post')
+    try:
+        my_posts = mastodon.account_statuses(id=persona.current().bot_id, limit=20, exclude_replies=True)
+        # Pick a post from a few days ago
+        older_posts = [p for p in my_posts[5:] if not p.reblog]
+
+        if older_posts:
+            target_post = random.choice(older_posts)
+            old_text = status_text(target_post).strip()
+
+            if old_text:
+                review_system = system_with_voice(
+                    "You are looking back at one of your own previous posts and reacting to it. "
+                    "Be honest — was it good? cringe? funny? did it age well? "
+                    "This is a self-review. Be terse and real. Keep it very short.",
                     bot_memory=bot_memory,
+                    context=old_text,
                 )
 
-                now_str = datetime.now(ET).strftime("%A, %B %d, %Y")
-                count_prompt = (
-                    f"Current date: {now_str}\n\n"
-                    f"Recent activity:\n{activity_context}\n\n"
-                    "Post one count. Just the text, nothing else."
+                review_prompt = (
+                    f"Here's one of your old posts:\n\n"
+                    f"{old_text[:300]}\n\n"
+                    "Write a brief self-review as a reply. Just the text, nothing else."
                 )
 
-                count = generate(count_system, count_prompt, max_tokens=40)
-                if count.startswith('"') and count.endswith('"'):
-                    count = count[1:-1]
+                review = generate(review_system, review_prompt, max_tokens=60, max_length=240)
 
-                if count and len(count) < 200:
+                if review and len(review) < 240:
                     if not DEBUG:
-                        mastodon.status_post(status=count)
-                        print(f'The count: {count}')
+                        posted = mastodon.status_post(status=review, in_reply_to_id=target_post.id)
+                        store.record('review', status=posted)
+                        remember_posts([review])
+                        print(f'Self-review of "{old_text[:40]}": {review}')
                     else:
-                        print(f'Would post count: {count}')
-        except Exception as e:
-            print(f'Error with the count: {e}')
+                        print(f'Would self-review "{old_text[:40]}": {review}')
+    except Exception as e:
+        print(f'Error reviewing post history: {e}')
 
 
-    # Play Lilt — occasionally send a move to @familiarlilt
-    LILT_BOT_ID = "113479368818279476"
-    LILT_HANDLE = "@familiarlilt"
+def run_count(api, store, now_et, bot_memory, activity):
+    """The count — track an arbitrary thing with no context."""
+    print('\nChecking the count...')
+    metrics.phase('count')
+    mastodon = api.feature('post')
+    try:
+        activity_context = format_activity(activity)
+        if activity_context:
+            count_system = system_with_voice(
+                "You have an obsessive habit of counting arbitrary things based on "
+                f"{persona.current().source_name}'s recent activity. Pick something oddly specific to count and "
+                "post the count with zero context. Examples of the format:\n"
+                "- days since last hitchcock movie: 4\n"
+                "- consecutive runs under 6 miles: 3\n"
+                "- films watched this month: 7\n"
+                "- pokemon cards posted since last shiny: 12\n\n"
+                "Pick something real from the activity feed. Be specific and a little weird. "
+                "Just the count line, nothing else. lowercase, no punctuation at the end.",
+                bot_memory=bot_memory,
+                context=activity_context,
+            )
 
-    # Lilt is exempt from daily post cap — it's an e2e test
-    if awake:
-        print('\nPlaying Lilt...')
-        try:
-            # Check for the latest reply from @familiarlilt to us
-            my_statuses = mastodon.account_statuses(id=BOT_ID, limit=30)
-            lilt_statuses = mastodon.account_statuses(id=LILT_BOT_ID, limit=20)
-
-            # Find our most recent Lilt-related post (mention of @familiarlilt)
-            our_last_lilt = None
-            for s in my_statuses:
-                f2 = HTMLFilter()
-                f2.feed(s.content)
-                if LILT_HANDLE.lower() in f2.text.lower() or LILT_HANDLE.lower() in s.content.lower():
-                    our_last_lilt = s
-                    break
+            now_str = now_et.strftime("%A, %B %d, %Y")
+            count_prompt = (
+                f"Current date: {now_str}\n\n"
+                f"Recent activity:\n{activity_context}\n\n"
+                "Post one count. Just the text, nothing else."
+            )
 
-            # Find the latest reply from @familiarlilt to us
-            lilt_reply = None
-            for s in lilt_statuses:
-                if s.in_reply_to_account_id and str(s.in_reply_to_account_id) == BOT_ID:
-                    f2 = HTMLFilter()
-                    f2.feed(s.content)
-                    lilt_reply = f2.text.strip()
-                    lilt_reply_id = s.id
-                    break
+            count = generate(count_system, count_prompt, max_tokens=40, max_length=200)
 
-            if lilt_reply:
-                # We have an active game — decide next move
-                print(f'Lilt said: {lilt_reply[:100]}')
-
-                # Check if we already replied to this
-                already_replied = False
-                for s in my_statuses:
-                    if s.in_reply_to_id == lilt_reply_id:
-                        already_replied = True
-                        break
-
-                if not already_replied:
-                    lilt_system = system_with_voice(
-                        "You are playing Lilt, a text adventure game on Mastodon. "
-                        "You play by mentioning @familiarlilt with a command. "
-                        "Valid commands: go to [place], look around, look at [thing], "
-                        "take [item], drop [item], use [item], open [thing], "
-                        "talk to [npc], give [item] to [npc] for [item], check inventory.\n\n"
-                        "You're playing as yourself — curious, exploratory, a little cautious. "
-                        "Pick ONE command based on what the game just told you. "
-                        "Just output the command, nothing else. No @mention, no quotes.",
-                        bot_memory=bot_memory,
-                    )
+            if count and len(count) < 200:
+                if not DEBUG:
+                    posted = mastodon.status_post(status=count)
+                    store.record('count', status=posted)
+                    remember_posts([count])
+                    print(f'The count: {count}')
+                else:
+                    print(f'Would post count: {count}')
+    except Exception as e:
+        print(f'Error with the count: {e}')
 
-                    lilt_prompt = (
-                        f"The game just said:\n\n{lilt_reply[:500]}\n\n"
-                        "What's your next move? Just the command."
-                    )
 
-                    move = generate(lilt_system, lilt_prompt, max_tokens=40)
-                    if move.startswith('"') and move.endswith('"'):
-                        move = move[1:-1]
-                    # Strip any @mention the model might add
-                    move = re.sub(r'@\S+\s*', '', move).strip()
+def run_lilt(api, store, bot_memory):
+    """Play Lilt — occasionally send a move to the persona's Lilt bot.
 
-                    if move and len(move) < 200:
-                        status = f"{LILT_HANDLE} {move}"
-                        if not DEBUG:
-                            mastodon.status_post(
-                                status=status,
-                                in_reply_to_id=lilt_reply_id,
-                                visibility="unlisted",
-                            )
-                            print(f'Lilt move: {move}')
-                        else:
-                            print(f'Would play Lilt: {move}')
-                else:
-                    print('Already replied to last Lilt message.')
+    Lilt is exempt from daily post cap — it's an e2e test.
+    """
+    me = persona.current()
+    lilt_id, lilt_handle = me.lilt['id'], me.lilt['handle']
+    print('\nPlaying Lilt...')
+    metrics.phase('lilt')
+    mastodon = api.feature('lilt')
+    try:
+        # Check for the latest reply from the Lilt bot to us
+        my_statuses = mastodon.account_statuses(id=me.bot_id, limit=30)
+        lilt_statuses = mastodon.account_statuses(id=lilt_id, limit=20)
+
+        # Find our most recent Lilt-related post (mention of the Lilt bot)
+        our_last_lilt = None
+        for s in my_statuses:
+            if lilt_handle.lower() in status_text(s).lower() or lilt_handle.lower() in s.content.lower():
+                our_last_lilt = s
+                break
+
+        # Find the latest reply from the Lilt bot to us
+        lilt_reply = None
+        for s in lilt_statuses:
+            if s.in_reply_to_account_id and str(s.in_reply_to_account_id) == me.bot_id:
+                lilt_reply = status_text(s).strip()
+                lilt_reply_id = s.id
+                break
+
+        if lilt_reply:
+            # We have an active game — decide next move
+            print(f'Lilt said: {lilt_reply[:100]}')
+
+            if store.has_replied_to(lilt_reply_id):
+                print('Already replied to last Lilt message.')
+            elif not store.claim(lilt_reply_id):
+                print('Last Lilt message is already being answered this run.')
+            else:
+                lilt_system = system_with_voice(
+                    "You are playing Lilt, a text adventure game on Mastodon. "
+                    f"You play by mentioning {lilt_handle} with a command. "
+                    "Valid commands: go to [place], look around, look at [thing], "
+                    "take [item], drop [item], use [item], open [thing], "
+                    "talk to [npc], give [item] to [npc] for [item], check inventory.\n\n"
+                    "You're playing as yourself — curious, exploratory, a little cautious. "
+                    "Pick ONE command based on what the game just told you. "
+                    "Just output the command, nothing else. No @mention, no quotes.",
+                    bot_memory=bot_memory,
+                    context=lilt_reply,
+                )
 
-            elif not our_last_lilt:
-                # No active game — start one
-                status = f"{LILT_HANDLE} start"
-                if not DEBUG:
-                    mastodon.status_post(status=status, visibility="unlisted")
-                    print('Started a new Lilt game!')
-                else:
-                    print('Would start a new Lilt game.')
+                lilt_prompt = (
+                    f"The game just said:\n\n{lilt_reply[:500]}\n\n"
+                    "What's your next move? Just the command."
+                )
+
+                # Game commands repeat by design, so skip the duplicate check
+                move = generate(lilt_system, lilt_prompt, max_tokens=40, max_length=200,
+                                check_duplicates=False)
+                # Strip any @mention the model might add
+                move = re.sub(r'@\S+\s*', '', move).strip()
+
+                if move and len(move) < 200:
+                    status = f"{lilt_handle} {move}"
+                    if not DEBUG:
+                        posted = mastodon.status_post(
+                            status=status,
+                            in_reply_to_id=lilt_reply_id,
+                            visibility="unlisted",
+                        )
+                        store.record('lilt', status=posted)
+                        print(f'Lilt move: {move}')
+                    else:
+                        print(f'Would play Lilt: {move}')
+
+        elif not our_last_lilt:
+            # No active game — start one
+            status = f"{lilt_handle} start"
+            if not DEBUG:
+                posted = mastodon.status_post(status=status, visibility="unlisted")
+                store.record('lilt', status=posted)
+                print('Started a new Lilt game!')
             else:
-                print('Waiting for Lilt to respond...')
+                print('Would start a new Lilt game.')
+        else:
+            print('Waiting for Lilt to respond...')
 
-        except Exception as e:
-            print(f'Error playing Lilt: {e}')
+    except Exception as e:
+        print(f'Error playing Lilt: {e}')
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['refill']:
+        refill()
+    else:
+        main()
@@ -0,0 +1,114 @@
+"""
+Runs the features a run has planned at the same time.
+
+Each feature is a coroutine on one asyncio event loop. Mastodon.py and the
+Anthropic calls underneath are blocking, so the body of each feature runs
+on a worker thread of its own while its coroutine waits on it. The engine
+adds the scheduling:
+
+- at most FEATURE_CONCURRENCY features run at once; the rest wait their turn
+- each feature gets FEATURE_TIMEOUT seconds
+- every feature stops at the shared `deadline` (a time.monotonic() value),
+  which lambda_handler ties to the invocation's remaining time
+
+A thread can't be stopped from outside, so a feature that runs out of time
+is cancelled instead: `cancelled()` turns true on its thread, and on the
+threads it starts, and RateLimitScheduler and ebooks.complete refuse to
+make any more calls for it. Whatever it was about to post never goes out.
+A call already in flight still finishes, though, so `run` gives cancelled
+features up to CANCEL_GRACE seconds to record it before returning, and the
+caller doesn't close the state store under them. `submit` and `settle` do
+the same for work started outside the engine (see ebooks.fetch_concurrently).
+
+Each feature runs in its own copy of the caller's context, which is how
+metrics.phase keeps their timings and token counts apart.
+"""
+import contextvars
+import threading
+import time
+
+import metrics
+from local_settings import *
+
+_cancel = contextvars.ContextVar('cancel', default=None)
+
+
+def cancelled():
+    """Whether the feature running in this context has been given up on."""
+    event = _cancel.get()
+    return event is not None and event.is_set()
+
+
+def submit(pool, fn, *args):
+    """Start `fn(*args)` on `pool` in a copy of this context that can be cancelled.
+
+    Returns the future and the threading.Event that cancels it.
+    """
+    event = threading.Event()
+    context = contextvars.copy_context()
+    context.run(_cancel.set, event)
+    return pool.submit(context.run, fn, *args), event
+
+
+def settle(cancelled, grace=CANCEL_GRACE):
+    """Wait up to `grace` seconds for the `cancelled` futures ({name: future}) to finish."""
+    if not cancelled:
+        return
+    from concurrent.futures import wait
+
+    _, running = wait(cancelled.values(), timeout=grace)
+    for name, future in cancelled.items():
+        if future in running:
+            print(f'{name} still running {grace}s after it was given up on.')
+
+
+def run(features, deadline=None, concurrency=FEATURE_CONCURRENCY, timeout=FEATURE_TIMEOUT):
+    """Run `features` ({name: function}) concurrently and wait for all of them.
+
+    A feature that raises is logged and doesn't affect the others. One that
+    was given up on is waited for (see `settle`) before this returns.
+    """
+    if not features:
+        return
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    given_up = {}
+
+    def in_phase(fn):
+        # Whatever phase the feature starts ends with it
+        try:
+            fn()
+        finally:
+            metrics.phase(None)
+
+    async def run_all():
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run_one(name, fn):
+            async with slots:
+                left = timeout if deadline is None else min(timeout, deadline - time.monotonic())
+                if left <= 0:
+                    print(f'No time left for {name}.')
+                    return
+                future, event = submit(pool, in_phase, fn)
+                try:
+                    await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), left)
+                except asyncio.TimeoutError:
+                    event.set()
+                    given_up[name] = future
+                    print(f'Gave up on {name} after {left:.1f}s.')
+                except Exception as e:
+                    print(f'Error in {name}: {e!r}')
+
+        await asyncio.gather(*(run_one(name, fn) for name, fn in features.items()))
+
+    # A thread per feature, so one that timed out doesn't hold up the ones
+    # still waiting. Not a with block, so it doesn't hold up the run either.
+    pool = ThreadPoolExecutor(max_workers=len(features))
+    try:
+        asyncio.run(run_all())
+        settle(given_up)
+    finally:
+        pool.shutdown(wait=False)
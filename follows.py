@@ -0,0 +1,137 @@
+"""
+Follow-back management from a snapshot of the bot's followers and follows.
+
+Both lists are kept in the state store. Mastodon returns them newest first,
+so a sync only pages until it reaches an account it already knows. Nobody
+leaving shows up that way, so the snapshot is also checked against the
+followers_count / following_count on the bot's account and refetched in full
+when they disagree, or after FOLLOW_FULL_SYNC_HOURS regardless.
+
+Who to follow back or unfollow is the difference between the two snapshots.
+At most FOLLOW_ACTIONS_PER_RUN of those are carried out per run, oldest
+first; the rest stay pending in the snapshot for the next one. Follow-backs
+that didn't take (locked accounts, errors) go in a 'requested' list and
+aren't retried until the next full sync of who we follow.
+"""
+import time
+
+import persona
+from mastodon_client import Deferred
+from local_settings import *
+
+PAGE_SIZE = 80  # Mastodon's maximum accounts per page
+
+
+def rows(accounts):
+    return [(account.id, account.acct, account.bot) for account in accounts]
+
+
+def fetch_new(mastodon, page, known):
+    """Accounts from `page` onwards not in `known`, stopping at the first known one."""
+    new = []
+    while page:
+        fresh = [account for account in page if str(account.id) not in known]
+        new.extend(fresh)
+        if len(fresh) < len(page):
+            break
+        page = mastodon.fetch_next(page)
+    return new
+
+
+def fetch_all(mastodon, page):
+    accounts = []
+    while page:
+        accounts.extend(page)
+        page = mastodon.fetch_next(page)
+    return accounts
+
+
+def sync(mastodon, store):
+    """Bring the 'follower' and 'following' snapshots up to date.
+
+    Returns what's still to do, like `pending`.
+    """
+    bot_id = persona.current().bot_id
+    me = mastodon.account(bot_id)
+    lists = {
+        'follower': (me.followers_count, lambda: mastodon.account_followers(id=bot_id, limit=PAGE_SIZE)),
+        'following': (me.following_count, lambda: mastodon.account_following(id=bot_id, limit=PAGE_SIZE)),
+    }
+    for relation, (count, first_page) in lists.items():
+        known = store.account_ids(relation)
+        synced_at = float(store.get_meta(f'{relation}_synced_at', 0))
+
+        if known and time.time() - synced_at < FOLLOW_FULL_SYNC_HOURS * 3600:
+            new = fetch_new(mastodon, first_page(), known)
+            # Stored oldest first, so pending follow-backs go in the order they came
+            store.add_accounts(relation, rows(reversed(new)))
+            if len(known) + len(new) == count:
+                print(f'{relation}: {len(new)} new, {count} total')
+                continue
+
+        accounts = fetch_all(mastodon, first_page())
+        store.replace_accounts(relation, rows(reversed(accounts)))
+        if relation == 'following':
+            store.replace_accounts('requested', [])
+        store.set_meta(f'{relation}_synced_at', str(time.time()))
+        print(f'{relation}: fully synced {len(accounts)} accounts')
+
+    return pending(store)
+
+
+def pending(store):
+    """(follows, unfollows) still to do, as (id, acct) pairs, oldest first."""
+    me = persona.current()
+    followers = store.accounts('follower')
+    following = store.accounts('following')
+    follower_ids = {id for id, _, _ in followers}
+    following_ids = {id for id, _, _ in following} | store.account_ids('requested')
+
+    follows = [(id, acct) for id, acct, bot in followers
+               if id not in following_ids and not bot and id != me.bot_id]
+    # Never unfollow the source account
+    unfollows = [(id, acct) for id, acct, _ in following
+                 if id not in follower_ids and id != me.source_id]
+    return follows, unfollows
+
+
+def apply(mastodon, store, follows, unfollows, limit=FOLLOW_ACTIONS_PER_RUN):
+    """Follow back new followers and unfollow anyone who left, up to `limit` calls."""
+    done = 0
+
+    for account_id, acct in follows:
+        if done >= limit:
+            break
+        done += 1
+        try:
+            relationship = mastodon.account_follow(id=account_id)
+        except Deferred:
+            raise
+        except Exception as e:
+            print(f'Error following @{acct}: {e}')
+            store.add_accounts('requested', [(account_id, acct, False)])
+            continue
+        # A locked account only gets a request, which doesn't count as following
+        relation = 'following' if relationship.following else 'requested'
+        store.add_accounts(relation, [(account_id, acct, False)])
+        store.record('follow', target_id=account_id)
+        print(f'Followed back: @{acct}')
+
+    for account_id, acct in unfollows:
+        if done >= limit:
+            break
+        done += 1
+        try:
+            mastodon.account_unfollow(id=account_id)
+        except Deferred:
+            raise
+        except Exception as e:
+            print(f'Error unfollowing @{acct}: {e}')
+            continue
+        store.remove_account('following', account_id)
+        store.record('unfollow', target_id=account_id)
+        print(f'Unfollowed: @{acct}')
+
+    left = len(follows) + len(unfollows) - done
+    if left > 0:
+        print(f'{left} follow changes left for later runs.')
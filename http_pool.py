@@ -0,0 +1,191 @@
+"""
+Pooled keep-alive HTTP connections shared by everything the bot talks to.
+
+Mastodon.py and the activity feed share one requests.Session, and the
+Anthropic SDK gets one client of its own httpx flavour. Both are created on
+first use and live at module level, so a warm Lambda container carries its
+open connections into the next invocation instead of opening new ones.
+Whether they're still alive by then is up to the server; a dropped
+connection is replaced transparently.
+
+Both use one SSLContext with the CA bundle loaded once per process. Without
+it, requests loads the bundle again for every new connection.
+
+`stats()` counts requests and new connections per client since the process
+started. `report(before)` turns two snapshots into a line for the run log.
+
+Both clients also record to, or replay from, a cassette (see cassette.py).
+"""
+import threading
+
+import cassette
+from local_settings import *
+
+_lock = threading.RLock()
+_ssl_context = None
+_session = None
+_anthropic_client = None
+_anthropic_counts = {'requests': 0, 'connections': 0}
+
+
+def ssl_context():
+    global _ssl_context
+    with _lock:
+        if _ssl_context is None:
+            import ssl
+
+            try:
+                import certifi
+
+                _ssl_context = ssl.create_default_context(cafile=certifi.where())
+            except ImportError:
+                _ssl_context = ssl.create_default_context()
+        return _ssl_context
+
+
+def session():
+    """The shared requests.Session, for Mastodon.py and plain GETs."""
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            class PooledAdapter(HTTPAdapter):
+                def init_poolmanager(self, *args, **kwargs):
+                    kwargs['ssl_context'] = ssl_context()
+                    super().init_poolmanager(*args, **kwargs)
+
+                def cert_verify(self, conn, url, verify, cert):
+                    super().cert_verify(conn, url, verify, cert)
+                    if verify is True:
+                        # The shared context already trusts the bundle
+                        conn.ca_certs = conn.ca_cert_dir = None
+
+                def send(self, request, **kwargs):
+                    if cassette.MODE == 'replay':
+                        return self.replay(request)
+                    response = super().send(request, **kwargs)
+                    if cassette.MODE == 'record':
+                        cassette.record(request.method, request.url, request.body,
+                                        response.status_code, response.headers, response.content)
+                    return response
+
+                def replay(self, request):
+                    from requests.structures import CaseInsensitiveDict
+                    from requests.utils import get_encoding_from_headers
+
+                    recorded = cassette.reply(request.method, request.url, request.body)
+                    if recorded is None:
+                        raise requests.ConnectionError(f'Not in cassette: {request.method} {request.url}',
+                                                       request=request)
+                    response = requests.Response()
+                    response.status_code, headers, response._content = recorded
+                    response.headers = CaseInsensitiveDict(headers)
+                    response.encoding = get_encoding_from_headers(response.headers)
+                    response.url = request.url
+                    response.request = request
+                    response.connection = self
+                    return response
+
+            _session = requests.Session()
+            adapter = PooledAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def anthropic_http_client():
+    """The shared HTTP client for the Anthropic SDK.
+
+    Built from the SDK's own DefaultHttpxClient and Limits types, so it
+    matches whichever httpx package that SDK version is built on. When a
+    cassette is recording or replaying, requests go through a transport
+    that does that instead.
+    """
+    global _anthropic_client
+    with _lock:
+        if _anthropic_client is None:
+            import anthropic
+
+            def trace(event, info):
+                if event == 'connection.connect_tcp.complete':
+                    with _lock:
+                        _anthropic_counts['connections'] += 1
+
+            def count(request):
+                with _lock:
+                    _anthropic_counts['requests'] += 1
+                request.extensions['trace'] = trace
+
+            limits = type(anthropic.DEFAULT_CONNECTION_LIMITS)(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            )
+            kwargs = {}
+            if cassette.MODE is not None:
+                kwargs['transport'] = _cassette_transport(type(limits), verify=ssl_context(), limits=limits)
+            _anthropic_client = anthropic.DefaultHttpxClient(
+                verify=ssl_context(),
+                limits=limits,
+                event_hooks={'request': [count]},
+                **kwargs,
+            )
+        return _anthropic_client
+
+
+def _cassette_transport(limits_type, **kwargs):
+    """A recording or replaying transport from the same httpx package as `limits_type`."""
+    import importlib
+
+    httpx = importlib.import_module(limits_type.__module__.split('.')[0])
+
+    class RecordingTransport(httpx.HTTPTransport):
+        def handle_request(self, request):
+            response = super().handle_request(request)
+            cassette.record(request.method, str(request.url), request.read(),
+                            response.status_code, dict(response.headers), response.read())
+            return response
+
+    class ReplayTransport(httpx.BaseTransport):
+        def handle_request(self, request):
+            recorded = cassette.reply(request.method, str(request.url), request.read())
+            if recorded is None:
+                raise httpx.ConnectError(f'Not in cassette: {request.method} {request.url}', request=request)
+            status, headers, content = recorded
+            return httpx.Response(status, headers=headers, content=content, request=request)
+
+    if cassette.MODE == 'replay':
+        return ReplayTransport()
+    return RecordingTransport(**kwargs)
+
+
+def stats():
+    """{client: (requests, new connections)} since the process started."""
+    counts = {}
+    if _session is not None:
+        requests = connections = 0
+        for adapter in set(_session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    requests += pool.num_requests
+                    connections += pool.num_connections
+        counts['session'] = (requests, connections)
+    if _anthropic_client is not None:
+        counts['anthropic'] = (_anthropic_counts['requests'], _anthropic_counts['connections'])
+    return counts
+
+
+def report(before):
+    """One line summarizing connection reuse since the `before` snapshot."""
+    parts = []
+    for name, (requests, connections) in stats().items():
+        requests -= before.get(name, (0, 0))[0]
+        connections -= before.get(name, (0, 0))[1]
+        if requests:
+            parts.append(f'{name} {requests} requests, {connections} new connections, '
+                         f'{requests - connections} reused')
+    return f'HTTP: {"; ".join(parts) or "no requests"}'
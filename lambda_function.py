@@ -1,13 +1,34 @@
 import json
+import time
 
 import ebooks
+import warm_cache
 
 
 def lambda_handler(event, context):
+    # Counted per invocation; the cache itself lasts as long as the container
+    warm_before = warm_cache.stats()
+    # Features give up in time for the run to save its state
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000
 
-    ebooks.main()
+    ebooks.main(deadline=deadline)
 
+    print(warm_cache.report(warm_before))
     return {
         'statusCode': 200,
         'body': json.dumps('Ran ebooks.py!')
     }
+
+
+def refill_handler(event, context):
+    warm_before = warm_cache.stats()
+
+    ebooks.refill()
+
+    print(warm_cache.report(warm_before))
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Refilled the post queue!')
+    }
@@ -1,13 +1,52 @@
 """
-Local settings for @robot_mk.
+Local settings for @robot_mk and the other personas in personas.json.
 """
 
-SOURCE_ID = "231610"  # @mknepprath@mastodon.social
+PERSONAS_PATH = 'personas.json'  # the bot accounts to run, and what they override here (see persona.py)
+PERSONA_CONCURRENCY = 4  # personas run at once
 ODDS = 18  # ~1 in 18 per invocation (runs hourly = ~1 post/day)
 FAVE_ODDS = 3  # favorite mentions often
 REPLY_ODDS = 3  # reply to mentions sometimes
+MAX_MENTIONS_PER_RUN = 5  # replies sent in one run; extra mentions wait for the next
 BOOST_ODDS = 16  # rarely boost @mknepprath's posts
 MAX_POSTS_PER_DAY = 3  # hard cap on total posts (all types combined)
+VOICE_RELEVANT_SAMPLES = 10  # archive posts picked by similarity to the context
+VOICE_RANDOM_SAMPLES = 5  # plus this many random ones for variety
+GENERATION_CANDIDATES = 3  # most candidate generations per post (see generate in ebooks.py)
+GENERATION_PICK = 'first'  # 'first' usable candidate back, or 'best' of all of them
+DUPLICATE_THRESHOLD = 0.6  # reject posts this similar to the archive or our own posts
+DUPLICATE_MIN_LENGTH = 20  # shorter posts ("heck yeah") are allowed to repeat
 DEBUG = False  # Set this to False to start posting live
-BOT_ACCOUNT = '@robot_mk@mastodon.social'
-BOT_ID = "109795650318013893"
+STATE_PATH = '/tmp/{persona}_state.sqlite3'  # action history (see state.py); one per persona
+STATE_S3_BUCKET = None  # set to keep state across cold starts, e.g. 'robotmk'
+STATE_S3_KEY = 'state/{persona}_state.sqlite3'
+DEDUPE_PATH = '/tmp/{persona}_dedupe.pickle'  # near-duplicate index (see dedupe.py)
+ACTIVITY_CACHE_PATH = '/tmp/{persona}_activity.json'  # see activity_feed.py
+ACTIVITY_TTL = 30 * 60  # seconds before the cached feed is revalidated
+ACTIVITY_TIMEOUT = 5  # seconds; the bot carries on without the feed
+SOURCE_SYNC_PAGES = 5  # pages of new @mknepprath statuses fetched per run
+SOURCE_BACKFILL_PAGES = 1  # pages of older history backfilled per run
+FOLLOW_ACTIONS_PER_RUN = 10  # follows + unfollows per run; the rest wait for the next
+FOLLOW_FULL_SYNC_HOURS = 24  # refetch the follower lists in full at least this often
+MASTODON_BUDGETS = {  # feature: (server requests per run, skip it with this few requests left in the window)
+    'core': (10, 0),  # state rebuild and the bot's own recent posts
+    'post': (20, 0),
+    'replies': (30, 20),
+    'follows': (100, 100),
+    'boost': (10, 50),
+    'lilt': (5, 50),
+}
+HTTP_POOL_SIZE = 10  # keep-alive connections per host (see http_pool.py)
+HTTP_KEEPALIVE_EXPIRY = 90  # seconds an idle Anthropic connection is kept
+POST_QUEUE_PATH = '/tmp/{persona}_post_queue.json'  # posts generated ahead (see post_queue.py)
+POST_QUEUE_S3_KEY = 'state/{persona}_post_queue.json'
+POST_QUEUE_SIZE = 2  # posts a refill keeps queued for the day (~1 goes out per day)
+WARM_CACHE_SIZE = 64  # entries kept between invocations on a warm container (see warm_cache.py)
+WARM_TIMELINE_TTL = 6 * 3600  # seconds a cached timeline is topped up before it's refetched in full
+WARM_STATE_TTL = 24 * 3600  # seconds for what's read from the state database
+FEATURE_CONCURRENCY = 4  # features run at once (see engine.py)
+FEATURE_TIMEOUT = 60  # seconds a feature gets before it's given up on
+DEADLINE_MARGIN = 10  # seconds of the Lambda's time kept back for saving state
+CANCEL_GRACE = 5  # seconds of that a given-up feature gets to finish the call it's in (see engine.py)
+METRICS = True  # one CloudWatch EMF record per run (see metrics.py); False makes it a no-op
+METRICS_NAMESPACE = 'robot_mk'
@@ -0,0 +1,349 @@
+"""
+Wrappers around the Mastodon client used by ebooks.py.
+"""
+import contextlib
+import functools
+import threading
+import time
+
+import engine
+import metrics
+import warm_cache
+from local_settings import *
+
+# Client methods that change what account timelines return. Calling any of
+# them drops the cached copy of the bot's own timeline so later reads in the
+# run see the change.
+WRITE_METHODS = {
+    "status_post",
+    "status_reblog",
+    "status_unreblog",
+    "status_favourite",
+    "status_unfavourite",
+    "status_delete",
+}
+
+
+PAGE_SIZE = 40  # Mastodon's maximum statuses per page
+
+
+class CachedMastodon:
+    """Coalesce account timeline reads for the length of one run.
+
+    Each account timeline is fetched once, at the largest limit any caller
+    will ask for (see `limits`), and every later `account_statuses` call is
+    answered by slicing that copy. With and without replies are separate
+    timelines, fetched from the server, which fills the whole limit with
+    statuses that aren't replies. Concurrent callers asking
+    for the same account wait on the first fetch instead of issuing their
+    own. Paginated reads (max_id, min_id, since_id) and every other method
+    go straight to the wrapped client.
+
+    `connect` builds that client. It isn't called until the first request,
+    so a run that never talks to Mastodon never pays for the import.
+
+    Timelines also go in the warm cache (see warm_cache.py), so a later run
+    on the same container only asks for statuses newer than the ones it
+    has. They're kept per `own_id`, since statuses carry the viewing
+    account's favourited and reblogged flags. Deletions and edits show up
+    once WARM_TIMELINE_TTL has passed and the timeline is fetched in full
+    again.
+
+    Writes drop the cached timeline of `own_id`, the account the client
+    posts as, or every cached timeline when it isn't given. Other accounts'
+    timelines are kept, though a boost or favourite leaves their flags on
+    the cached copy stale.
+
+    `sent()` counts the requests each thread has sent to the server, so
+    RateLimitScheduler only charges for those and not for cache hits, and
+    inside `refusing(reason)` a call that would send one raises Deferred
+    instead, so a feature that's out of budget can still read the cache.
+    """
+
+    def __init__(self, connect, limits=None, own_id=None):
+        self._connect = connect
+        self._mastodon = None
+        self._limits = {str(k): v for k, v in (limits or {}).items()}
+        self._own_id = None if own_id is None else str(own_id)
+        self._timelines = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._sent = threading.local()
+        # account_statuses calls sent to the server and answered from the cache
+        self.fetches = 0
+        self.hits = 0
+
+    def sent(self):
+        """Requests the calling thread has sent to the server through this client."""
+        return getattr(self._sent, 'count', 0)
+
+    def _send(self):
+        refused = getattr(self._sent, 'refused', None)
+        if refused:
+            raise Deferred(refused)
+        self._sent.count = self.sent() + 1
+
+    @contextlib.contextmanager
+    def refusing(self, reason):
+        """Raise Deferred(reason) instead of sending requests from this thread."""
+        previous = getattr(self._sent, 'refused', None)
+        self._sent.refused = reason
+        try:
+            yield
+        finally:
+            self._sent.refused = previous
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._mastodon is None:
+                self._mastodon = self._connect()
+            return self._mastodon
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _account_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def account_statuses(self, id, limit=20, exclude_replies=False, **kwargs):
+        if any(v is not None for v in kwargs.values()):
+            self._count('fetches')
+            self._send()
+            return self.client.account_statuses(
+                id=id, limit=limit, exclude_replies=exclude_replies, **kwargs)
+
+        key = (str(id), bool(exclude_replies))
+        with self._account_lock(key):
+            cached = self._timelines.get(key)
+            if cached is None or cached[0] < limit:
+                fetch_limit = max(limit, self._limits.get(str(id), 0))
+                statuses = self._fetch_timeline(id, fetch_limit, bool(exclude_replies))
+                self._count('fetches')
+                cached = (fetch_limit, statuses)
+                self._timelines[key] = cached
+            else:
+                self._count('hits')
+        return cached[1][:limit]
+
+    def _fetch_timeline(self, id, limit, exclude_replies):
+        """The newest `limit` statuses of `id`, topping up a warm copy if there is one."""
+        key = ('timeline', self._own_id, str(id), exclude_replies)
+        warm = warm_cache.get(key)
+        statuses = None
+        if warm is not None and warm[0] >= limit and warm[1]:
+            self._send()
+            newer = list(self.client.account_statuses(id=id, limit=limit, exclude_replies=exclude_replies,
+                                                      min_id=warm[1][0].id))
+            # min_id pages forward from the cursor, so a full page (the server
+            # caps them at PAGE_SIZE) may have left out the newest statuses
+            if len(newer) < min(limit, PAGE_SIZE):
+                newer.sort(key=lambda status: int(status.id), reverse=True)
+                statuses = (newer + warm[1])[:warm[0]]
+        if statuses is None:
+            self._send()
+            statuses = list(self.client.account_statuses(id=id, limit=limit, exclude_replies=exclude_replies))
+            warm_cache.put(key, (limit, statuses), WARM_TIMELINE_TTL)
+        else:
+            # Keeps the original expiry, so the full refetch still comes round
+            warm[1][:] = statuses
+        return statuses
+
+    def invalidate(self):
+        with self._lock:
+            if self._own_id is None:
+                self._timelines.clear()
+            else:
+                for exclude_replies in (False, True):
+                    self._timelines.pop((self._own_id, exclude_replies), None)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._send()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                if name in WRITE_METHODS:
+                    self.invalidate()
+
+        return call
+
+
+class Deferred(Exception):
+    """A feature is out of calls for this run. It picks up again next run."""
+
+
+class RateLimitScheduler:
+    """Per-feature call budgets on top of the server's rate limit.
+
+    `mastodon` is a CachedMastodon. Every call goes through `feature(name)`,
+    which charges the requests it sends to the server to that feature;
+    reads answered from the cache are free. `budgets` maps a feature to
+    `(calls, floor)`: it may send at most `calls` requests per run, and none
+    while the account has `floor` or fewer requests left before the rate
+    limit resets, though it can still read the cache. Giving low-priority
+    features a high floor leaves what's left of the window to the ones that
+    matter.
+
+    The remaining/reset values come from the X-RateLimit headers Mastodon.py
+    tracks on the client, and can be seeded from the previous run so a run
+    that starts inside a spent window skips work instead of hitting the
+    limit. The client should use ratelimit_method="throw": a feature that
+    hits the limit is deferred to the next run rather than sleeping.
+    """
+
+    def __init__(self, mastodon, budgets, remaining=None, reset=None):
+        self.mastodon = mastodon
+        self.budgets = budgets
+        self.remaining = remaining
+        self.reset = reset
+        self.used = {}
+        self.deferred = set()
+        self._lock = threading.Lock()
+
+    def feature(self, name):
+        return FeatureClient(self, name)
+
+    def _left(self):
+        """Requests left in the current window, or None if unknown."""
+        if self.remaining is None or self.reset is None or self.reset <= time.time():
+            return None
+        return self.remaining
+
+    def _check(self, feature):
+        calls, floor = self.budgets[feature]
+        if self.used.get(feature, 0) >= calls:
+            return f'{feature} used its {calls} requests'
+        left = self._left()
+        if left is not None and left <= floor:
+            return f'{left} requests left until {time.strftime("%H:%M:%S", time.localtime(self.reset))}'
+        return None
+
+    def allows(self, feature):
+        """Whether `feature` should start at all this run."""
+        with self._lock:
+            reason = self._check(feature)
+            if reason:
+                self.deferred.add(feature)
+        if reason:
+            print(f'Deferring {feature} to the next run: {reason}')
+        return reason is None
+
+    def _observe(self):
+        client = self.mastodon.client
+        reset = getattr(client, 'ratelimit_reset', None)
+        # Before the first response these are Mastodon.py's defaults, with
+        # reset in the past; keep whatever we already knew instead.
+        if reset is not None and reset > time.time():
+            with self._lock:
+                self.remaining = client.ratelimit_remaining
+                self.reset = reset
+
+    def call(self, feature, name, *args, **kwargs):
+        if engine.cancelled():
+            raise Deferred(f'{feature} ran out of time')
+        with self._lock:
+            reason = self._check(feature)
+            # Held until we know how many requests the call actually sent
+            held = 0 if reason else 1
+            self.used[feature] = self.used.get(feature, 0) + held
+        before = self.mastodon.sent()
+        try:
+            with metrics.span(f'mastodon.{name}'):
+                if reason:
+                    # Out of requests, but what's cached can still be read
+                    with self.mastodon.refusing(reason):
+                        return getattr(self.mastodon, name)(*args, **kwargs)
+                return getattr(self.mastodon, name)(*args, **kwargs)
+        except Deferred:
+            with self._lock:
+                self.deferred.add(feature)
+            raise
+        except Exception as e:
+            from mastodon import MastodonRatelimitError
+
+            if isinstance(e, MastodonRatelimitError):
+                with self._lock:
+                    self.remaining = 0
+                    self.deferred.add(feature)
+                raise Deferred(f'rate limited during {name}') from e
+            raise
+        finally:
+            with self._lock:
+                self.used[feature] += self.mastodon.sent() - before - held
+            self._observe()
+
+    def summary(self):
+        used = ', '.join(f'{feature} {count}' for feature, count in sorted(self.used.items()) if count)
+        left = self._left()
+        line = f'Mastodon requests: {used or "none"}; {"?" if left is None else left} left in window'
+        line += f'; timelines {self.mastodon.fetches} fetched, {self.mastodon.hits} from the run cache'
+        if self.deferred:
+            line += f'; deferred {", ".join(sorted(self.deferred))}'
+        return line
+
+
+class FeatureClient:
+    """The Mastodon client as seen by one feature; see RateLimitScheduler."""
+
+    def __init__(self, scheduler, feature):
+        self._scheduler = scheduler
+        self._feature = feature
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self._scheduler.mastodon, name)
+        if not callable(attr):
+            return attr
+        return functools.partial(self._scheduler.call, self._feature, name)
+
+
+_type_hints_cached = False
+
+
+def cache_type_hints():
+    """Make Mastodon.py 2.x look up each entity class's type hints only once.
+
+    Its entity dicts call typing.get_type_hints on their class, and on the
+    class's __init__, for every field they're given, which makes decoding a
+    page of statuses take seconds. The hints never change, so they're kept
+    per class. Each caller gets its own copy, since Mastodon.py updates the
+    dict it's given. Does nothing on Mastodon.py versions without this.
+    """
+    global _type_hints_cached
+    if _type_hints_cached:
+        return
+    try:
+        from mastodon import types_base
+    except ImportError:
+        return
+
+    get_type_hints = types_base.get_type_hints
+    hints_by_class = {}
+
+    def cached_type_hints(obj, *args, **kwargs):
+        if args or kwargs:
+            return get_type_hints(obj, *args, **kwargs)
+        try:
+            hints = hints_by_class[obj]
+        except KeyError:
+            try:
+                hints = get_type_hints(obj)
+            except Exception:
+                hints = None
+            hints_by_class[obj] = hints
+        if hints is None:
+            raise TypeError(f'no type hints for {obj!r}')
+        return dict(hints)
+
+    types_base.get_type_hints = cached_type_hints
+    _type_hints_cached = True
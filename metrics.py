@@ -0,0 +1,170 @@
+"""
+Timing and token metrics for one invocation.
+
+- `phase(name)` marks where run() is: it ends the current phase and starts
+  timing the next, so feature blocks don't need re-indenting to be timed.
+  The phase belongs to the current context, so features running side by
+  side (see engine.py) each have their own
+- `span(name)` times a block (an API call, a fetch) and counts how often
+  it ran; spans can nest and run on any thread. `@timed(name)` does the
+  same for a whole function
+- `usage(response.usage)` adds an Anthropic response's tokens, and their
+  estimated cost, to the current phase. Batch results pass BATCH_RATE
+
+Everything is aggregated in memory and written by `emit()` as one JSON line
+in CloudWatch Embedded Metric Format. Lambda sends stdout to CloudWatch
+Logs, which turns the record into metrics with no agent or API calls.
+
+`reset(service)` starts the record for one persona's run, in the current
+context. Personas running side by side each get their own record, with
+their name as its Service dimension.
+
+With METRICS = False, `span` hands back a shared no-op context manager and
+everything else returns immediately.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+
+from local_settings import *
+
+# USD per million tokens for the model ebooks.complete uses
+PRICES = {
+    'input': 1.00,
+    'output': 5.00,
+    'cache_read': 0.10,
+    'cache_write': 1.25,
+}
+BATCH_RATE = 0.5  # Message Batches bill half the usual price
+
+
+_NULL = contextlib.nullcontext()
+_lock = threading.Lock()
+_timings = {}  # service -> {name: [seconds, count]}
+_tokens = {}  # service -> {phase: {kind: tokens}}
+_costs = {}  # service -> {phase: USD}
+_service = contextvars.ContextVar('service', default=METRICS_NAMESPACE)
+_phase = contextvars.ContextVar('phase', default=None)  # (name, started)
+
+
+def reset(service=METRICS_NAMESPACE):
+    with _lock:
+        _timings[service] = {}
+        _tokens[service] = {}
+        _costs[service] = {}
+    _service.set(service)
+    _phase.set(None)
+
+
+def _add_time(name, seconds):
+    with _lock:
+        timing = _timings.setdefault(_service.get(), {}).setdefault(name, [0.0, 0])
+        timing[0] += seconds
+        timing[1] += 1
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def span(name):
+    return _Span(name) if METRICS else _NULL
+
+
+def timed(name):
+    """Decorator form of span(name)."""
+    def decorate(fn):
+        if not METRICS:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _Span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def phase(name):
+    """End the current phase and start `name` (None just ends it)."""
+    if not METRICS:
+        return
+    now = time.perf_counter()
+    current = _phase.get()
+    if current is not None:
+        _add_time(f'phase.{current[0]}', now - current[1])
+    _phase.set((name, now) if name is not None else None)
+
+
+def usage(usage, rate=1.0):
+    """Add an Anthropic `response.usage`, billed at `rate` times PRICES, to the current phase."""
+    if not METRICS:
+        return
+    current = _phase.get()
+    name = current[0] if current is not None else 'other'
+    counts = {
+        'input': usage.input_tokens or 0,
+        'output': usage.output_tokens or 0,
+        'cache_read': getattr(usage, 'cache_read_input_tokens', 0) or 0,
+        'cache_write': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+    }
+    service = _service.get()
+    with _lock:
+        tokens = _tokens.setdefault(service, {}).setdefault(name, dict.fromkeys(PRICES, 0))
+        for kind, count in counts.items():
+            tokens[kind] += count
+        costs = _costs.setdefault(service, {})
+        costs[name] = costs.get(name, 0.0) + rate * sum(
+            count * PRICES[kind] for kind, count in counts.items()) / 1_000_000
+
+
+def record():
+    """The current persona's metrics for the invocation as a CloudWatch EMF record."""
+    service = _service.get()
+    values = {}
+    units = {}
+    with _lock:
+        costs = _costs.get(service, {})
+        for name, (seconds, count) in _timings.get(service, {}).items():
+            values[f'{name}.ms'] = round(seconds * 1000, 3)
+            units[f'{name}.ms'] = 'Milliseconds'
+            values[f'{name}.count'] = count
+        for name, tokens in _tokens.get(service, {}).items():
+            for kind, count in tokens.items():
+                values[f'tokens.{name}.{kind}'] = count
+                units[f'tokens.{name}.{kind}'] = 'Count'
+            values[f'cost.{name}'] = round(costs[name], 6)
+            units[f'cost.{name}'] = 'None'
+
+    return {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['Service']],
+                # EMF takes at most 100 metrics per record; the rest are still logged
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit in list(units.items())[:100]],
+            }],
+        },
+        'Service': service,
+        **values,
+    }
+
+
+def emit():
+    if METRICS:
+        print(json.dumps(record(), separators=(',', ':')))
@@ -0,0 +1,171 @@
+"""
+The bot accounts one process runs, loaded from PERSONAS_PATH.
+
+PERSONAS_PATH is a JSON list with one object per persona:
+
+    name           used in its state file names, S3 keys and metrics
+    account        the bot's handle, e.g. "@robot_mk@mastodon.social"
+    bot_id         the bot's account id
+    source_id      the account it's a doppelganger of...
+    source_handle  ...its handle, e.g. "@mknepprath"...
+    source_name    ...and what the prompts call its owner, e.g. "Michael"
+    system_prompt  text file with the persona's system prompt
+    voice_samples  JSON archive of the owner's posts (default voice_samples.json);
+                   the packed .bin, the .npz index and the .dedupe.pickle
+                   near-duplicate index sit next to it, except for the default
+                   archive, which uses voice_index.npz and voice_dedupe.pickle
+    activity_url   activity feed to give the prompts as background (optional)
+    credentials    prefix of its Mastodon environment variables: "ROBOT_MK"
+                   means ROBOT_MK_MASTODON_ACCESS_TOKEN and so on. Without it
+                   the unprefixed variables are used
+    siblings       {account id: {"handle", "context"}} of accounts the
+                   commentary feature shares posts from (optional)
+    lilt           {"id", "handle"} of the Lilt game bot it plays (optional)
+    settings       overrides for the local_settings.py names in SETTINGS
+
+Relative paths are taken from this directory. STATE_PATH, DEDUPE_PATH,
+POST_QUEUE_PATH, ACTIVITY_CACHE_PATH and their S3 keys are templates
+filled in with `path()`, so each persona keeps its own files.
+
+ebooks.main() runs every persona at once, each in its own context, and
+`current()` is the one the calling code is running for. Code that runs
+outside any persona's context gets the first one in the file.
+
+`python persona.py build DIR` packs every persona's voice samples and
+builds their retrieval and near-duplicate indexes into DIR (deploy.sh does).
+"""
+import contextvars
+import json
+import os
+import sys
+
+import local_settings
+from local_settings import *
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Settings a persona can override; everything else is shared
+SETTINGS = {
+    'ODDS',
+    'FAVE_ODDS',
+    'REPLY_ODDS',
+    'BOOST_ODDS',
+    'MAX_POSTS_PER_DAY',
+    'MAX_MENTIONS_PER_RUN',
+    'MASTODON_BUDGETS',
+    'POST_QUEUE_SIZE',
+}
+
+_personas = None
+_current = contextvars.ContextVar('persona', default=None)
+
+
+def _path(path):
+    return os.path.join(HERE, path)
+
+
+class Persona:
+    def __init__(self, config):
+        self.name = config['name']
+        self.account = config['account']
+        self.bot_id = str(config['bot_id'])
+        self.source_id = str(config['source_id'])
+        self.source_handle = config['source_handle']
+        self.source_name = config['source_name']
+        self.system_prompt_path = _path(config['system_prompt'])
+        self.activity_url = config.get('activity_url')
+        self.credentials = config.get('credentials')
+        self.siblings = {str(id): bot for id, bot in config.get('siblings', {}).items()}
+        self.lilt = config.get('lilt')
+        self.settings = config.get('settings', {})
+        unknown = set(self.settings) - SETTINGS
+        if unknown:
+            raise ValueError(f'{self.name}: settings that can\'t be overridden: {", ".join(sorted(unknown))}')
+
+        samples = config.get('voice_samples')
+        if samples is None:
+            self.voice_samples = _path('voice_samples.json')
+            self.voice_store = _path('voice_samples.bin')
+            self.voice_index = _path('voice_index.npz')
+            self.voice_dedupe = _path('voice_dedupe.pickle')
+        else:
+            base = os.path.splitext(_path(samples))[0]
+            self.voice_samples, self.voice_store, self.voice_index = _path(samples), base + '.bin', base + '.npz'
+            self.voice_dedupe = base + '.dedupe.pickle'
+        self._system_prompt = None
+
+    def __repr__(self):
+        return f'<Persona {self.name}>'
+
+    @property
+    def system_prompt(self):
+        if self._system_prompt is None:
+            with open(self.system_prompt_path) as f:
+                self._system_prompt = f.read().strip()
+        return self._system_prompt
+
+    def setting(self, name):
+        """This persona's value for the local_settings.py `name`."""
+        if name in self.settings:
+            return self.settings[name]
+        return getattr(local_settings, name)
+
+    def path(self, template):
+        """A STATE_PATH-style template filled in for this persona."""
+        return template.format(persona=self.name)
+
+    def env(self, name, default=None):
+        """The environment variable `name`, under this persona's credentials prefix."""
+        if self.credentials:
+            name = f'{self.credentials}_{name}'
+        return os.environ.get(name, default)
+
+
+def load(path=PERSONAS_PATH):
+    """Every persona, read from `path` the first time."""
+    global _personas
+    if _personas is None:
+        with open(_path(path)) as f:
+            personas = [Persona(config) for config in json.load(f)]
+        names = [p.name for p in personas]
+        if not personas or len(set(names)) != len(names):
+            raise ValueError(f'{path} needs at least one persona, each with its own name')
+        _personas = personas
+    return _personas
+
+
+def current():
+    return _current.get() or load()[0]
+
+
+def use(persona):
+    """Make `persona` current for the rest of this context."""
+    _current.set(persona)
+
+
+def build(out_dir):
+    """Pack every persona's voice samples and build their indexes under `out_dir`."""
+    import dedupe
+    import voice_index
+    import voice_store
+
+    built = set()
+    for persona in load():
+        if persona.voice_samples in built:
+            continue
+        built.add(persona.voice_samples)
+        store = os.path.join(out_dir, os.path.relpath(persona.voice_store, HERE))
+        index = os.path.join(out_dir, os.path.relpath(persona.voice_index, HERE))
+        duplicates = os.path.join(out_dir, os.path.relpath(persona.voice_dedupe, HERE))
+        os.makedirs(os.path.dirname(store), exist_ok=True)
+        count = voice_store.build(persona.voice_samples, store)
+        samples, terms = voice_index.build(persona.voice_samples, index)
+        shingled = dedupe.build(persona.voice_samples, duplicates)
+        print(f'{persona.name}: packed {count} voice samples, indexed {samples} ({terms} terms), '
+              f'{shingled} for near-duplicates')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['build'] or len(sys.argv) != 3:
+        sys.exit('Usage: python persona.py build DIR')
+    build(sys.argv[2])
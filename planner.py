@@ -0,0 +1,62 @@
+"""
+Decide what a run will do before it fetches anything.
+
+Every feature is rolled up front. The ones that fire, and that the
+Mastodon budget can cover, make up the run's plan. The plan says what
+data those actions need, so ebooks.run fetches just that, all in one
+concurrent batch. When nothing fires, nothing is fetched.
+
+Lilt isn't rolled. It plays every run its budget allows, as before.
+Personas without siblings or a Lilt bot (see persona.py) never plan
+commentary or Lilt.
+"""
+import persona
+
+# feature -> (odds, Mastodon budget it's charged to, what it needs fetched)
+# Odds given as a setting's name are the persona's value of it
+FEATURES = {
+    'post': ('ODDS', 'post', ('memory', 'posts', 'activity')),
+    'reply': ('REPLY_ODDS', 'replies', ('memory', 'mentions')),
+    'boost': ('BOOST_ODDS', 'boost', ('source_timeline',)),
+    'commentary': ('BOOST_ODDS', 'boost', ('memory', 'sibling_timeline')),
+    'source_reply': (36, 'replies', ('memory', 'source_timeline')),
+    'follow': (6, 'follows', ('follows',)),
+    'follower_reply': (48, 'replies', ('memory', 'follows')),
+    'review': (72, 'post', ('memory',)),
+    'count': (48, 'post', ('memory', 'activity')),
+    'lilt': (None, 'lilt', ('memory', 'lilt_timeline')),
+}
+
+
+def plan(roll, api, forced=()):
+    """The features that run this time, in FEATURES order.
+
+    `roll(feature, odds)` is ebooks.roll. Features in `forced` run without
+    a roll. Either way, a feature whose budget `api` won't allow is
+    deferred to the next run.
+    """
+    me = persona.current()
+    actions = []
+    for feature, (odds, budget, _) in FEATURES.items():
+        if (feature == 'commentary' and not me.siblings) or (feature == 'lilt' and not me.lilt):
+            continue
+        if isinstance(odds, str):
+            odds = me.setting(odds)
+        if odds is not None and feature not in forced and roll(feature, odds) != 0:
+            continue
+        if api.allows(budget):
+            actions.append(feature)
+    return actions
+
+
+def needs(actions):
+    """{need: budget to charge its fetch to} for everything `actions` use.
+
+    A need shared by several actions goes to the first one's budget.
+    """
+    needed = {}
+    for action in actions:
+        _, budget, wants = FEATURES[action]
+        for need in wants:
+            needed.setdefault(need, budget)
+    return needed
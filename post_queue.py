@@ -0,0 +1,118 @@
+"""
+Posts generated ahead of time, waiting to go out.
+
+`ebooks.refill()` fills the queue off the hot path through the Message
+Batches API, which costs half as much as live calls but can take a while
+to finish. A refill submits a batch when the queue is short and nothing is
+in flight, and collects the batch's results on a later call once it has
+ended, so it's meant to be scheduled every hour or so. An hourly run that
+rolls a post takes the oldest fresh entry instead of generating one.
+
+Each entry is written for one day in Eastern time, since the prompt gives
+the model the date. An entry that drew on the activity feed also remembers
+the newest few items it saw, and goes stale as soon as the feed has moved
+on from them. Stale entries are dropped when they're reached.
+
+The queue is a small JSON file at POST_QUEUE_PATH, kept in S3 alongside the
+state when STATE_S3_BUCKET is set. It's fetched again on every load, because
+the refill usually runs on another container.
+"""
+import hashlib
+import json
+import os
+import threading
+
+from local_settings import *
+
+# The feed items a queued post is checked against
+ACTIVITY_LINES = 5
+
+
+def activity_key(activity_context):
+    """A fingerprint of the newest items in a formatted activity feed."""
+    newest = '\n'.join(activity_context.splitlines()[:ACTIVITY_LINES])
+    return hashlib.sha1(newest.encode()).hexdigest()
+
+
+class PostQueue:
+    def __init__(self, path=POST_QUEUE_PATH, s3_bucket=STATE_S3_BUCKET, s3_key=POST_QUEUE_S3_KEY):
+        self.path = path
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        if self.s3_bucket:
+            self._download()
+        self.entries = []
+        # The batch in flight: {'id': ..., 'requests': {custom_id: [day, activity]}}
+        self.batch = None
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.entries = saved['entries']
+            self.batch = saved['batch']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _s3(self):
+        import boto3  # Provided by the Lambda runtime; only needed with S3 state
+
+        return boto3.client("s3")
+
+    def _download(self):
+        try:
+            self._s3().download_file(self.s3_bucket, self.s3_key, self.path)
+        except Exception as e:
+            print(f'No post queue in S3: {e}')
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'entries': self.entries, 'batch': self.batch}, f)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        if self.s3_bucket:
+            try:
+                self._s3().upload_file(self.path, self.s3_bucket, self.s3_key)
+            except Exception as e:
+                print(f'Error saving post queue to S3: {e}')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, text, day, activity=None):
+        """Queue `text`, written for `day` (an ISO date) and the feed `activity` key."""
+        with self._lock:
+            self.entries.append({'text': text, 'day': day, 'activity': activity})
+            self._dirty = True
+
+    def set_batch(self, batch):
+        with self._lock:
+            self.batch = batch
+            self._dirty = True
+
+    def drop_stale(self, day, activity=None):
+        """Drop entries not written for `day`, or for the feed `activity` key, if known."""
+        with self._lock:
+            fresh = [entry for entry in self.entries
+                     if entry['day'] == day
+                     and (entry['activity'] is None or activity is None or entry['activity'] == activity)]
+            dropped = len(self.entries) - len(fresh)
+            if dropped:
+                self.entries = fresh
+                self._dirty = True
+        return dropped
+
+    def pop(self, usable=lambda text: True):
+        """The oldest entry `usable(text)` accepts, or None. Passed-over entries are dropped."""
+        with self._lock:
+            while self.entries:
+                entry = self.entries.pop(0)
+                self._dirty = True
+                if usable(entry['text']):
+                    return entry['text']
+        return None
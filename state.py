@@ -0,0 +1,349 @@
+"""
+Persistent record of everything the bot does, so "have I already..." checks
+don't have to scan its own timeline, plus a local copy of the source
+account's statuses and of the bot's followers and follows, both synced
+incrementally.
+
+The store is a SQLite file. On Lambda /tmp only survives while the container
+is warm, so if STATE_S3_BUCKET is set the file is pushed to S3 on close and
+pulled back when opened, unless the copy in /tmp is already the one in S3
+(the object's ETag is kept next to the file). Another container may have
+run since this one last did. A store with no history is rebuilt from the bot's
+recent statuses (see `rebuild_from_timeline`).
+
+The source corpus texts and the follow lists are also read into the warm
+cache (see warm_cache.py), so a warm container doesn't rebuild them from
+the file every run. Writing to either drops the cached copy.
+"""
+import html
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+import warm_cache
+from local_settings import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status_id TEXT,
+    in_reply_to_id TEXT,
+    target_id TEXT,
+    url TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS actions_status_id ON actions (status_id);
+CREATE INDEX IF NOT EXISTS actions_in_reply_to_id ON actions (in_reply_to_id);
+CREATE INDEX IF NOT EXISTS actions_kind_target ON actions (kind, target_id);
+CREATE INDEX IF NOT EXISTS actions_url ON actions (url);
+CREATE INDEX IF NOT EXISTS actions_created_at ON actions (created_at);
+CREATE TABLE IF NOT EXISTS source_statuses (
+    id INTEGER PRIMARY KEY,
+    is_reply INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    relation TEXT NOT NULL,
+    id TEXT NOT NULL,
+    acct TEXT NOT NULL,
+    bot INTEGER NOT NULL,
+    PRIMARY KEY (relation, id)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Links in status HTML; the visible text is split into invisible/ellipsis spans, so use the href
+LINK_RE = re.compile(r'<a\s[^>]*>')
+HREF_RE = re.compile(r'href="(https?://[^"]+)"')
+
+
+def links(content):
+    """URLs linked from status HTML, leaving out mentions and hashtags."""
+    urls = []
+    for link in LINK_RE.findall(content or ''):
+        href = HREF_RE.search(link)
+        if href and 'mention' not in link and 'hashtag' not in link:
+            urls.append(html.unescape(href.group(1)))
+    return urls
+
+
+def to_utc(dt):
+    """Sortable UTC timestamp string. Naive datetimes are taken as UTC."""
+    if dt is None:
+        dt = datetime.now(timezone.utc)
+    elif dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+class StateStore:
+    def __init__(self, path=STATE_PATH, s3_bucket=STATE_S3_BUCKET, s3_key=STATE_S3_KEY):
+        self.path = path
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._claims = set()
+        # False when S3 couldn't be read, so close() doesn't overwrite what's there
+        self._can_upload = True
+
+        if self.s3_bucket:
+            self._download()
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def _cached(self, key, load):
+        key = (key, self.path)
+        value = warm_cache.get(key)
+        if value is None:
+            value = load()
+            warm_cache.put(key, value, WARM_STATE_TTL)
+        return value
+
+    def _forget(self, key):
+        warm_cache.discard((key, self.path))
+
+    def _s3(self):
+        import boto3  # Provided by the Lambda runtime; only needed with S3 state
+
+        return boto3.client("s3")
+
+    def _etag(self):
+        """ETag of the S3 object the local file was last downloaded from or uploaded to."""
+        try:
+            with open(self.path + '.etag') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _save_etag(self, etag):
+        with open(self.path + '.etag', 'w') as f:
+            f.write(etag)
+
+    def _download(self):
+        try:
+            s3 = self._s3()
+            etag = s3.head_object(Bucket=self.s3_bucket, Key=self.s3_key)['ETag']
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                print(f'No state in S3, starting fresh: {e}')
+            else:
+                self._can_upload = False
+                print(f'Error checking state in S3, not saving it back this run: {e}')
+            return
+        if os.path.exists(self.path) and self._etag() == etag:
+            return
+        tmp = self.path + '.download'
+        try:
+            # IfMatch, so a copy uploaded since the HEAD isn't saved under the old ETag
+            body = s3.get_object(Bucket=self.s3_bucket, Key=self.s3_key, IfMatch=etag)['Body']
+            with open(tmp, 'wb') as f:
+                for chunk in iter(lambda: body.read(1 << 20), b''):
+                    f.write(chunk)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            self._can_upload = False
+            print(f'Error loading state from S3, not saving it back this run: {e}')
+            return
+        self._save_etag(etag)
+        # What was read from the old file is stale now
+        warm_cache.discard_matching(lambda key: isinstance(key, tuple) and key[1:] == (self.path,))
+        print(f'Loaded state from s3://{self.s3_bucket}/{self.s3_key}')
+
+    def close(self, upload=True):
+        """Save the store, and push it to S3 if it changed unless `upload` is False."""
+        with self._lock:
+            self.db.commit()
+            self.db.close()
+        if self.s3_bucket and self._dirty and upload and self._can_upload:
+            try:
+                s3 = self._s3()
+                s3.upload_file(self.path, self.s3_bucket, self.s3_key)
+                self._save_etag(s3.head_object(Bucket=self.s3_bucket, Key=self.s3_key)['ETag'])
+            except Exception as e:
+                print(f'Error saving state to S3: {e}')
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            cursor = self.db.execute(sql, args)
+            self.db.commit()
+            self._dirty = True
+            return cursor
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return self.db.execute(sql, args).fetchone()
+
+    def record(self, kind, status=None, target_id=None, url=None):
+        """Record an action. Pass the status it created, if any."""
+        status_id = in_reply_to_id = created_at = None
+        if status is not None:
+            status_id = str(status.id)
+            if status.in_reply_to_id is not None:
+                in_reply_to_id = str(status.in_reply_to_id)
+            created_at = status.created_at
+        self._execute(
+            "INSERT OR IGNORE INTO actions "
+            "(kind, status_id, in_reply_to_id, target_id, url, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, status_id, in_reply_to_id,
+             None if target_id is None else str(target_id), url, to_utc(created_at)),
+        )
+
+    def get_meta(self, key, default=None):
+        row = self._query("SELECT value FROM meta WHERE key = ?", (key,))
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def add_source_statuses(self, rows):
+        """Store (id, is_reply, text, created_at) rows for the source account."""
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO source_statuses (id, is_reply, text, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(int(id), int(is_reply), text, to_utc(created_at))
+                 for id, is_reply, text, created_at in rows],
+            )
+            self.db.commit()
+            self._dirty = True
+        self._forget('source_texts')
+
+    def source_id_range(self):
+        """(oldest, newest) stored source status IDs, or (None, None)."""
+        return self._query("SELECT MIN(id), MAX(id) FROM source_statuses")
+
+    def source_texts(self, limit=None):
+        """(posts, replies) text from the newest `limit` stored source statuses."""
+        texts = self._cached('source_texts', dict)  # limit -> (posts, replies)
+        if limit not in texts:
+            with self._lock:
+                rows = self.db.execute(
+                    "SELECT is_reply, text FROM source_statuses ORDER BY id DESC LIMIT ?",
+                    (-1 if limit is None else limit,),
+                ).fetchall()
+            texts[limit] = ([text for is_reply, text in rows if not is_reply],
+                            [text for is_reply, text in rows if is_reply])
+        posts, replies = texts[limit]
+        return list(posts), list(replies)
+
+    def accounts(self, relation):
+        """(id, acct, bot) for every account in `relation` (see follows.py), oldest first."""
+        def load():
+            with self._lock:
+                return self.db.execute(
+                    "SELECT id, acct, bot FROM accounts WHERE relation = ? ORDER BY rowid",
+                    (relation,),
+                ).fetchall()
+
+        return self._cached(f'accounts.{relation}', load)
+
+    def account_ids(self, relation):
+        return {row[0] for row in self.accounts(relation)}
+
+    def add_accounts(self, relation, rows):
+        """Add (id, acct, bot) rows to the `relation` snapshot."""
+        with self._lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO accounts (relation, id, acct, bot) VALUES (?, ?, ?, ?)",
+                [(relation, str(id), acct, int(bool(bot))) for id, acct, bot in rows],
+            )
+            self.db.commit()
+            self._dirty = True
+        self._forget(f'accounts.{relation}')
+
+    def replace_accounts(self, relation, rows):
+        """Replace the whole `relation` snapshot with (id, acct, bot) rows."""
+        rows = list(rows)
+        with self._lock:
+            self.db.execute("DELETE FROM accounts WHERE relation = ?", (relation,))
+            self.db.executemany(
+                "INSERT OR IGNORE INTO accounts (relation, id, acct, bot) VALUES (?, ?, ?, ?)",
+                [(relation, str(id), acct, int(bool(bot))) for id, acct, bot in rows],
+            )
+            self.db.commit()
+            self._dirty = True
+        self._forget(f'accounts.{relation}')
+
+    def remove_account(self, relation, account_id):
+        self._execute(
+            "DELETE FROM accounts WHERE relation = ? AND id = ?", (relation, str(account_id))
+        )
+        self._forget(f'accounts.{relation}')
+
+    def is_empty(self):
+        return self._query("SELECT 1 FROM actions LIMIT 1") is None
+
+    def rebuild_from_timeline(self, statuses):
+        """Seed the store from the bot's own statuses after a cold start."""
+        for s in statuses:
+            url = None
+            if s.reblog:
+                kind, target_id = "boost", s.reblog.id
+            else:
+                target_id = None
+                urls = links(s.content)
+                if s.in_reply_to_id is not None:
+                    kind = "reply"
+                elif urls:
+                    kind, url = "commentary", urls[-1]
+                else:
+                    kind = "post"
+            with self._lock:
+                self.db.execute(
+                    "INSERT OR IGNORE INTO actions "
+                    "(kind, status_id, in_reply_to_id, target_id, url, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (kind, str(s.id),
+                     None if s.in_reply_to_id is None else str(s.in_reply_to_id),
+                     None if target_id is None else str(target_id),
+                     url, to_utc(s.created_at)),
+                )
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('rebuilt_at', ?)",
+                (to_utc(None),),
+            )
+            self.db.commit()
+            self._dirty = True
+
+    def count_statuses_since(self, since):
+        """Statuses the bot has created (posts, replies, boosts) since `since`."""
+        row = self._query(
+            "SELECT COUNT(*) FROM actions WHERE status_id IS NOT NULL AND created_at >= ?",
+            (to_utc(since),),
+        )
+        return row[0]
+
+    def has_replied_to(self, status_id):
+        return self._query(
+            "SELECT 1 FROM actions WHERE in_reply_to_id = ? LIMIT 1", (str(status_id),)
+        ) is not None
+
+    def claim(self, status_id):
+        """Claim `status_id` to reply to. False if another feature in this run already has."""
+        with self._lock:
+            if str(status_id) in self._claims:
+                return False
+            self._claims.add(str(status_id))
+            return True
+
+    def has_boosted(self, status_id):
+        return self._query(
+            "SELECT 1 FROM actions WHERE kind = 'boost' AND target_id = ? LIMIT 1",
+            (str(status_id),),
+        ) is not None
+
+    def has_commented_on(self, url):
+        return self._query(
+            "SELECT 1 FROM actions WHERE url = ? LIMIT 1", (url,)
+        ) is not None
@@ -0,0 +1,115 @@
+"""
+TF-IDF retrieval index over the voice samples.
+
+Lets system_with_voice pick archive posts that look like the thing being
+replied to instead of a purely random handful. The index is built once at
+package time (`python voice_index.py`, run by deploy.sh) and saved as NumPy
+arrays in voice_index.npz:
+
+    vocab     sorted terms, newline-joined UTF-8 bytes
+    count     number of samples
+    idf       inverse document frequency per term
+    term_ptr  postings for term t are doc_ids/weights[term_ptr[t]:term_ptr[t + 1]]
+    doc_ids   sample index (same order as voice_samples.json)
+    weights   L2-normalized tf-idf weight of the term in that sample
+
+NumPy comes from the Lambda layer. Without it, or without the .npz, `load`
+returns None and callers fall back to random samples.
+"""
+import json
+import math
+import os
+import re
+import sys
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+JSON_PATH = os.path.join(HERE, "voice_samples.json")
+INDEX_PATH = os.path.join(HERE, "voice_index.npz")
+
+TOKEN_RE = re.compile(r"[a-z0-9']+")
+STOPWORDS = set("""
+a an and are as at be but by for from has have he his i i'm if in is it it's
+just me my of on or so that the this to was we with you your
+""".split())
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+class VoiceIndex:
+    def __init__(self, vocab, count, idf, term_ptr, doc_ids, weights):
+        self.terms = {term: i for i, term in enumerate(vocab)}
+        self.count = count
+        self.idf = idf
+        self.term_ptr = term_ptr
+        self.doc_ids = doc_ids
+        self.weights = weights
+
+    def top_k(self, text, k):
+        """Indices of the k samples most similar to `text`, best first."""
+        import numpy as np
+
+        query = Counter(self.terms[t] for t in tokenize(text) if t in self.terms)
+        if not query or k <= 0:
+            return []
+
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term, tf in query.items():
+            start, end = self.term_ptr[term], self.term_ptr[term + 1]
+            scores[self.doc_ids[start:end]] += (1 + math.log(tf)) * self.idf[term] * self.weights[start:end]
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])].tolist()
+
+
+def build(json_path=JSON_PATH, index_path=INDEX_PATH):
+    import numpy as np
+
+    with open(json_path, "r") as f:
+        samples = json.load(f)
+
+    docs = [Counter(tokenize(s)) for s in samples]
+    df = Counter(term for doc in docs for term in doc)
+    vocab = sorted(df)
+    terms = {term: i for i, term in enumerate(vocab)}
+    idf = np.array([math.log(len(docs) / df[t]) + 1 for t in vocab], dtype=np.float32)
+
+    postings = [[] for _ in vocab]
+    for doc_id, doc in enumerate(docs):
+        row = {terms[t]: (1 + math.log(tf)) * idf[terms[t]] for t, tf in doc.items()}
+        norm = math.sqrt(sum(w * w for w in row.values())) or 1.0
+        for term, w in row.items():
+            postings[term].append((doc_id, w / norm))
+
+    term_ptr = np.zeros(len(vocab) + 1, dtype=np.int32)
+    term_ptr[1:] = np.cumsum([len(p) for p in postings])
+    doc_ids = np.array([d for p in postings for d, _ in p], dtype=np.int32)
+    weights = np.array([w for p in postings for _, w in p], dtype=np.float32)
+
+    np.savez(index_path, vocab=np.frombuffer("\n".join(vocab).encode("utf-8"), dtype=np.uint8),
+             count=len(samples), idf=idf, term_ptr=term_ptr, doc_ids=doc_ids, weights=weights)
+    return len(samples), len(vocab)
+
+
+def load(index_path=INDEX_PATH):
+    try:
+        import numpy as np
+
+        with np.load(index_path) as data:
+            vocab = data["vocab"].tobytes().decode("utf-8").split("\n")
+            return VoiceIndex(vocab, int(data["count"]), data["idf"], data["term_ptr"],
+                              data["doc_ids"], data["weights"])
+    except Exception as e:
+        print(f'No voice index, using random samples: {e}')
+        return None
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:3]
+    samples, terms = build(*paths)
+    print(f"Indexed {samples} voice samples ({terms} terms)")
@@ -0,0 +1,80 @@
+"""
+Compact, memory-mapped store for voice samples.
+
+voice_samples.json has to be parsed whole before a single sample can be
+used. voice_samples.bin packs the same strings into one UTF-8 blob behind an
+offset table, so picking k samples only touches k entries:
+
+    b"VOX1" | count (uint32) | count + 1 offsets (uint32) | UTF-8 blob
+
+All integers are little-endian. Sample i is blob[offsets[i]:offsets[i + 1]].
+
+Build it from the JSON archive with `python voice_store.py` (deploy.sh does).
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"VOX1"
+HEADER = struct.Struct("<4sI")
+OFFSET = struct.Struct("<I")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+JSON_PATH = os.path.join(HERE, "voice_samples.json")
+BIN_PATH = os.path.join(HERE, "voice_samples.bin")
+
+
+class VoiceStore:
+    """Read-only sequence of samples backed by a memory-mapped .bin file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a voice sample store")
+        self._blob = HEADER.size + OFFSET.size * (self._count + 1)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        start, end = struct.unpack_from("<II", self._mm, HEADER.size + OFFSET.size * i)
+        return self._mm[self._blob + start:self._blob + end].decode("utf-8")
+
+
+def build(json_path=JSON_PATH, bin_path=BIN_PATH):
+    with open(json_path, "r") as f:
+        samples = json.load(f)
+
+    encoded = [s.encode("utf-8") for s in samples]
+    offsets = [0]
+    for e in encoded:
+        offsets.append(offsets[-1] + len(e))
+
+    with open(bin_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(encoded)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        for e in encoded:
+            f.write(e)
+    return len(encoded)
+
+
+def load(bin_path=BIN_PATH, json_path=JSON_PATH):
+    """The packed store if it's there, otherwise the JSON archive as a list."""
+    try:
+        return VoiceStore(bin_path)
+    except (OSError, ValueError, struct.error):
+        pass
+    with open(json_path, "r") as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:3]
+    count = build(*paths)
+    print(f"Packed {count} voice samples into {paths[1] if len(paths) > 1 else BIN_PATH}")
@@ -0,0 +1,91 @@
+"""
+Data kept in memory between invocations on a warm Lambda container.
+
+Lambda reuses a container for later invocations for as long as it stays
+warm, module globals included. Anything put here is there for the next
+run on the same container until its TTL runs out or it's pushed out by
+newer entries (at most WARM_CACHE_SIZE, least recently used first). A cold
+start begins empty, so every user has to cope with a miss. The cache is
+shared by every persona the process runs (see persona.py); keys carry the
+persona's account or state file wherever what's cached differs between
+them, and the activity feed is shared outright.
+
+What lives here:
+
+- account timelines (each bot's own, which its memory comes from, and
+  sibling bots, the source account and Lilt), which CachedMastodon tops up
+  with only the statuses newer than the cached ones
+- the parsed activity feed (see activity_feed.py)
+- the source corpus texts and follow lists read from the state database,
+  dropped whenever the database changes under them
+
+`stats()` snapshots the hit and miss counts, and `report(before)` turns two
+snapshots into a line for the run log, like http_pool.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from local_settings import *
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # key -> (expires, value)
+_counts = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+
+def get(key, default=None):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del _entries[key]
+            _counts['expired'] += 1
+            entry = None
+        if entry is None:
+            _counts['misses'] += 1
+            return default
+        _entries.move_to_end(key)
+        _counts['hits'] += 1
+        return entry[1]
+
+
+def put(key, value, ttl):
+    """Keep `value` under `key` for `ttl` seconds."""
+    with _lock:
+        _entries[key] = (time.monotonic() + ttl, value)
+        _entries.move_to_end(key)
+        while len(_entries) > WARM_CACHE_SIZE:
+            _entries.popitem(last=False)
+            _counts['evicted'] += 1
+
+
+def discard(key):
+    with _lock:
+        _entries.pop(key, None)
+
+
+def discard_matching(match):
+    """Drop every entry whose key `match(key)` is true for."""
+    with _lock:
+        for key in [key for key in _entries if match(key)]:
+            del _entries[key]
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def stats():
+    with _lock:
+        return dict(_counts, entries=len(_entries))
+
+
+def report(before):
+    """One line summarizing cache use since the `before` snapshot."""
+    now = stats()
+    hits, misses = now['hits'] - before['hits'], now['misses'] - before['misses']
+    line = f'Warm cache: {hits} hits, {misses} misses, {now["entries"]} entries'
+    expired, evicted = now['expired'] - before['expired'], now['evicted'] - before['evicted']
+    if expired or evicted:
+        line += f' ({expired} expired, {evicted} evicted)'
+    return line